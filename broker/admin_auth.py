@@ -0,0 +1,39 @@
+"""
+Authentication of the broker's admin endpoints.
+
+Every kiosk holds JWT_SECRET_KEY to sign its own tokens, so a claim in such a token cannot tell
+an admin from a kiosk. Admin tokens are signed with a separate key, ADMIN_JWT_SECRET_KEY, which
+only admins have. Without that key (or with the kiosks' key) the admin endpoints are disabled.
+"""
+import logging
+import os
+
+import jwt
+
+ADMIN_JWT_SECRET_KEY = os.getenv('ADMIN_JWT_SECRET_KEY')
+
+
+def enabled():
+    return bool(ADMIN_JWT_SECRET_KEY) and ADMIN_JWT_SECRET_KEY != os.getenv('JWT_SECRET_KEY')
+
+
+def check(authorization):
+    """
+    Check the Authorization header of a request to an admin endpoint.
+
+    Parameters:
+        authorization (str): Value of the Authorization header, "Bearer <token>", or None.
+
+    Returns:
+        tuple: An error message and HTTP status code, or None if the header carries a valid admin token.
+    """
+    if not enabled():
+        return "Admin endpoints are disabled, ADMIN_JWT_SECRET_KEY is not set", 403
+    if not authorization or not authorization.startswith("Bearer "):
+        return "Missing Authorization Header", 401
+    try:
+        jwt.decode(authorization[len("Bearer "):], ADMIN_JWT_SECRET_KEY, algorithms=["HS256"])
+    except jwt.InvalidTokenError as e:
+        logging.warning("Rejected admin token: %s", e)
+        return "Admin token required", 403
+    return None
@@ -0,0 +1,287 @@
+"""
+asyncio variant of the broker (aiohttp) with the same endpoints and JWT authentication as main.py.
+
+A request waiting on Vereinsflieger does not hold a thread, so one process can serve many
+kiosks behind a slow upstream. When a kiosk disconnects, its request handler is cancelled.
+
+    cd broker && python async_main.py
+"""
+import functools
+import logging
+import os
+import ssl
+import time
+
+import jwt
+from aiohttp import web
+
+import admin_auth
+import async_vf_data as vf_data
+import metrics
+import tracing
+from sale_journal import valid_amount, valid_memberid
+
+JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
+MAX_CART_LINES = 20
+# Routes that are polled by monitoring and not worth a trace
+UNTRACED_ROUTES = {'/metrics', '/traces', '/traces/{trace_id}'}
+
+REQUEST_SECONDS = metrics.histogram(
+    "broker_http_request_duration_seconds", "Duration of broker requests by route, method and status.")
+
+routes = web.RouteTableDef()
+
+
+def jwt_required(handler):
+    """Reject requests without a valid bearer token, with the status codes of flask_jwt_extended."""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        header = request.headers.get("Authorization", "")
+        if not header.startswith("Bearer "):
+            return web.json_response({"msg": "Missing Authorization Header"}, status=401)
+        try:
+            jwt.decode(header[len("Bearer "):], JWT_SECRET_KEY, algorithms=["HS256"])
+        except jwt.InvalidTokenError as e:
+            return web.json_response({"msg": str(e)}, status=422)
+        return await handler(request)
+    return wrapper
+
+
+async def json_object(request):
+    """Return the JSON body of a request if it is an object, otherwise None (Flask's get_json(silent=True))."""
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def reply(value):
+    """Answer like Flask does for a view's return value: dicts as JSON, strings as HTML."""
+    if isinstance(value, str):
+        return web.Response(text=value, content_type="text/html")
+    return web.json_response(value)
+
+
+@web.middleware
+async def observe_request(request, handler):
+    start = time.perf_counter()
+    status = 500
+    trace = tracing.Trace(request.path, request.headers.get(tracing.HEADER))
+    route = request.match_info.route.resource
+    route = route.canonical if route is not None else "unmatched"
+    try:
+        with tracing.use(trace):
+            response = await handler(request)
+        status = response.status
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route=route, method=request.method, status=str(status))
+        if route not in UNTRACED_ROUTES:
+            tracing.finish(trace, method=request.method, status=status)
+    response.headers[tracing.HEADER] = trace.id
+    if trace.stages:
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    return web.Response(text=metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+@routes.get('/traces')
+@jwt_required
+async def get_traces(request):
+    try:
+        limit = int(request.query.get('limit', 50))
+    except ValueError:
+        limit = 50
+    return web.json_response({"traces": [trace.to_dict() for trace in tracing.buffer.recent(limit)]})
+
+
+@routes.get('/traces/{trace_id}')
+@jwt_required
+async def get_trace(request):
+    traces = tracing.buffer.find(request.match_info['trace_id'])
+    if not traces:
+        return web.json_response({"message": "Unknown trace"}, status=404)
+    return web.json_response({"traces": [trace.to_dict() for trace in traces]})
+
+
+async def catalog_response(request, view, fallback):
+    """Answer with a pre-serialized catalog view and its ETag, or 304 if If-None-Match matches (see main.py)."""
+    catalog_json = await vf_data.get_catalog_json(view)
+    if catalog_json is None:
+        return reply(fallback)
+    body, etag = catalog_json
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("If-None-Match", "")
+    candidates = {candidate.strip() for candidate in if_none_match.split(",")}
+    candidates = {candidate[2:] if candidate.startswith("W/") else candidate for candidate in candidates}
+    if headers["ETag"] in candidates or "*" in candidates:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json", headers=headers)
+
+
+@routes.get('/getAllProducts')
+@jwt_required
+async def get_all_products(request):
+    return await catalog_response(request, "items", vf_data.CON_ERROR)
+
+
+@routes.get('/getFUProducts')
+@jwt_required
+async def get_fu_products(request):
+    return await catalog_response(request, "fu_items", {})
+
+
+@routes.get('/getValidFUProducts')
+@jwt_required
+async def get_valid_f_products(request):
+    return await catalog_response(request, "valid_fu_items", {})
+
+
+@routes.get('/test')
+@jwt_required
+async def test(request):
+    return reply("Hello World")
+
+
+@routes.post('/Buy')
+@jwt_required
+async def test_buy(request):
+    data = await json_object(request)
+    if data is None:
+        return web.json_response({"message": "Expected a JSON object"}, status=400)
+    if not valid_memberid(data.get('memberid')):
+        return web.json_response({"message": "Invalid memberid"}, status=400)
+    if not valid_amount(data.get('amount')):
+        return web.json_response({"message": "Invalid amount"}, status=400)
+    buyer = {
+        "memberid": data.get('memberid'),
+    }
+    valid_item = (await vf_data.get_valid_fu_products()).get(data.get('itemid'))
+    if valid_item:
+        # The sale is journaled and booked upstream in the background
+        saleid = await vf_data.record_sale(buyer, data.get('amount'), valid_item)
+        return web.json_response({"message": "Sale recorded", "saleid": saleid}, status=202)
+    return web.json_response({"message": "Invalid item"}, status=400)
+
+
+@routes.post('/BuyCart')
+@jwt_required
+async def buy_cart(request):
+    """Buy several items for one member, see main.buy_cart()."""
+    data = await json_object(request) or {}
+    memberid = data.get('memberid')
+    lines = data.get('items')
+    if not isinstance(lines, list) or not 0 < len(lines) <= MAX_CART_LINES:
+        return web.json_response({"message": f"Expected a memberid and 1 to {MAX_CART_LINES} items"}, status=400)
+    if not valid_memberid(memberid):
+        return web.json_response({"message": "Invalid memberid"}, status=400)
+    valid_items = await vf_data.get_valid_fu_products()
+    results = []
+    cart = []
+    for line in lines:
+        line = line if isinstance(line, dict) else {}
+        itemid = line.get('itemid')
+        amount = line.get('amount', 1)
+        valid_item = valid_items.get(itemid)
+        if valid_item is None:
+            results.append({"itemid": itemid, "amount": amount, "message": "Invalid item"})
+        elif not valid_amount(amount):
+            results.append({"itemid": itemid, "amount": amount, "message": "Invalid amount"})
+        else:
+            results.append({"itemid": itemid, "amount": amount})
+            cart.append((valid_item, amount))
+    if len(cart) < len(lines):
+        return web.json_response({"message": "Invalid cart", "lines": results}, status=400)
+    booked = await vf_data.book_cart({"memberid": memberid}, cart)
+    for result, booking in zip(results, booked):
+        result.update(booking)
+        result["message"] = "Sale booked" if booking["booked"] else "Sale recorded"
+    all_booked = all(booking["booked"] for booking in booked)
+    return web.json_response({"message": "Cart booked" if all_booked else "Cart recorded", "lines": results},
+                             status=200 if all_booked else 202)
+
+
+@routes.post('/admin/refreshCatalog')
+async def refresh_catalog(request):
+    # Signed with ADMIN_JWT_SECRET_KEY, not with the kiosks' key (see admin_auth)
+    error = admin_auth.check(request.headers.get("Authorization"))
+    if error is not None:
+        message, status = error
+        return web.json_response({"message": message}, status=status)
+    try:
+        snapshot = await vf_data.refresh_catalog()
+    except ConnectionError as e:
+        return web.json_response({"message": f"Catalog refresh failed: {e}"}, status=502)
+    return web.json_response({"message": "Catalog refreshed", "items": len(snapshot.items),
+                              "timestamp": snapshot.timestamp})
+
+
+@routes.get('/getSaleQueue')
+@jwt_required
+async def get_sale_queue(request):
+    return reply(await vf_data.get_sale_queue_depth())
+
+
+@routes.post('/getUserInfo')
+@jwt_required
+async def get_user_info(request):
+    data = await json_object(request)
+    if data is None:
+        return web.json_response({"message": "Expected a JSON object"}, status=400)
+    return reply(vf_data.get_user_info(data.get('rfid_id')))
+
+
+@routes.get('/getMemberIndexStats')
+@jwt_required
+async def get_member_index_stats(request):
+    return reply(vf_data.get_member_index_stats())
+
+
+@routes.post('/getSpecificProduct')
+@jwt_required
+async def get_product(request):
+    data = await json_object(request)
+    if data is None:
+        return web.json_response({"message": "Expected a JSON object"}, status=400)
+    product = await vf_data.get_product_for_row(data.get('row'))
+    if product:
+        return reply(product)
+    return reply("False")
+
+
+@routes.get('/getRowMap')
+@jwt_required
+async def get_row_map(request):
+    return reply(await vf_data.get_row_map())
+
+
+async def start_background_tasks(app):
+    await vf_data.start()
+    vf_data.start_catalog_scheduler()
+    yield
+    await vf_data.close()
+
+
+def create_app():
+    app = web.Application(middlewares=[observe_request])
+    app.add_routes(routes)
+    app.cleanup_ctx.append(start_background_tasks)
+    return app
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG if os.getenv('FLASK_ENV') == 'development' else logging.INFO)
+    ssl_context = None
+    if os.path.exists("data/cert.pem") and os.path.exists("data/key.pem"):
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain("data/cert.pem", "data/key.pem")
+    # handler_cancellation: cancel the handler when the kiosk closes the connection
+    web.run_app(create_app(), host="0.0.0.0", port=int(os.getenv('BROKER_PORT', '8124')),
+                ssl_context=ssl_context, handler_cancellation=True)
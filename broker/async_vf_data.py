@@ -0,0 +1,440 @@
+"""
+asyncio client for the Vereinsflieger API, used by the async broker (async_main.py).
+
+Mirrors the functions of vf_data.py with non-blocking HTTP (aiohttp). At most
+UPSTREAM_CONCURRENCY requests are in flight to Vereinsflieger at a time. The catalog refresh and
+the login are single-flight tasks that are shielded from cancellation: when the client whose
+request started them disconnects, the other waiting requests still get the result.
+"""
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import aiohttp
+
+import metrics
+import tracing
+from members import MemberIndex
+from sale_journal import SaleJournal
+from shared_cache import SharedCache
+from vf_common import (API_CONNECT_TIMEOUT, API_READ_TIMEOUT, CACHE_TTL, CART_PARALLELISM, CATALOG_LOOKUPS,
+                       CATALOG_REFRESH_INTERVAL, CON_ERROR, CON_ERRORS, LOGIN_RETRY_DELAY, LOGINS, MEMBER_FILE,
+                       MEMBER_LOOKUPS, SALE_JOURNAL_FILE, SALE_SUBMISSIONS, SESSION_TTL, SHARED_CACHE_FILE,
+                       SHARED_CHECK_INTERVAL, UPSTREAM_SECONDS, catalog_for_entry, checked_catalog_items,
+                       scheduled_refresh_done, submit_traced, upstream_stage)
+
+UPSTREAM_CONCURRENCY = int(os.environ.get("API_CONCURRENCY", 10))  # Requests in flight to the API
+HTTP_TIMEOUT = aiohttp.ClientTimeout(sock_connect=API_CONNECT_TIMEOUT, sock_read=API_READ_TIMEOUT)
+
+_api_token = os.environ.get("API_TOKEN")
+_api_username = os.environ.get("API_USERNAME")
+_api_password = os.environ.get("API_PASSWORD")
+_api_url = os.environ.get("API_URL")
+_api_cid = os.environ.get("API_CID")
+
+_http = None
+_upstream_slots = None
+_loop = None
+
+_member_index = MemberIndex(MEMBER_FILE)
+_shared = SharedCache(SHARED_CACHE_FILE)
+_catalog = None
+_catalog_checked = 0.0
+_catalog_task = None
+_catalog_scheduler = None
+
+_session_token = None
+_session_expires = 0.0
+_login_task = None
+_login_failed_at = 0.0
+
+
+async def start():
+    """Open the HTTP session and start the sale submission. Must be called on the serving event loop."""
+    global _http, _upstream_slots, _loop
+    _loop = asyncio.get_running_loop()
+    _upstream_slots = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+    _http = aiohttp.ClientSession(timeout=HTTP_TIMEOUT,
+                                  connector=aiohttp.TCPConnector(limit=UPSTREAM_CONCURRENCY))
+    _sale_journal.start()
+
+
+async def close():
+    if _catalog_scheduler is not None:
+        _catalog_scheduler.cancel()
+    if _http is not None:
+        await _http.close()
+
+
+async def _http_request(method, url, **kwargs):
+    """
+    Send a request to the API and return the status code and the decoded JSON body (None if the
+    body is no JSON). Waits for a free slot if UPSTREAM_CONCURRENCY requests are already running.
+
+    Raises:
+    ConnectionError: If the request fails or times out.
+    """
+    stage, endpoint = upstream_stage(url)
+    async with _upstream_slots:
+        with tracing.stage(stage, endpoint=endpoint), UPSTREAM_SECONDS.time(endpoint=endpoint, status="error") as labels:
+            try:
+                async with _http.request(method, url, **kwargs) as response:
+                    labels["status"] = str(response.status)
+                    try:
+                        return response.status, await response.json(content_type=None)
+                    except ValueError:
+                        return response.status, None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise ConnectionError(str(e) or type(e).__name__) from e
+
+
+async def get_access_token():
+    status, data = await _http_request("GET", _api_url + "interface/rest/auth/accesstoken")
+    return (data or {}).get("accesstoken")
+
+
+async def login():
+    """
+    Sign in at the API, see vf_data.login().
+
+    Raises:
+    ConnectionRefusedError: If the server returns 401.
+    ConnectionError: If the server returns any other status code than 200.
+
+    Returns:
+    str: The signed-in access token.
+    """
+    logging.info('logging user ' + _api_username + ' in...')
+    accesstoken = await get_access_token()
+    payload = {
+        'accesstoken': accesstoken,
+        "username": _api_username,
+        "password": hashlib.md5(_api_password.encode()).hexdigest(),
+        "appkey": _api_token,
+        "cid": _api_cid,
+    }
+    status, _ = await _http_request("POST", _api_url + "interface/rest/auth/signin", data=json.dumps(payload))
+    if status == 200:
+        return accesstoken
+    elif status == 401:
+        raise ConnectionRefusedError("Server returned 401, UNAUTHORIZED")
+    raise ConnectionError("Server returned " + str(status))
+
+
+async def _login_once():
+    global _session_token, _session_expires, _login_failed_at
+    try:
+        accesstoken = await login()
+    except ConnectionError:
+        LOGINS.inc(result="error")
+        _login_failed_at = time.time()
+        raise
+    LOGINS.inc(result="ok")
+    _session_token = accesstoken
+    _session_expires = time.time() + SESSION_TTL
+    return accesstoken
+
+
+async def get_session_token():
+    """
+    Return the signed-in access token, logging in only if none is cached or the cached one expired.
+
+    All requests that need a login while one is running await the same login task.
+
+    Raises:
+    ConnectionError: If the login fails or a login failed less than LOGIN_RETRY_DELAY seconds ago.
+    """
+    global _login_task
+    if _session_token and time.time() < _session_expires:
+        return _session_token
+    if _login_task is None or _login_task.done():
+        if time.time() - _login_failed_at < LOGIN_RETRY_DELAY:
+            raise ConnectionError("Login failed recently, not retrying yet")
+        _login_task = asyncio.ensure_future(_login_once())
+    return await asyncio.shield(_login_task)
+
+
+def invalidate_session(accesstoken):
+    global _session_token
+    if _session_token == accesstoken:
+        _session_token = None
+
+
+async def post_with_session(url, payload=None):
+    """
+    Send a POST request with the cached access token; on 401 log in again and send it once more.
+
+    Returns:
+    tuple: Status code and decoded JSON body of the last attempt.
+    """
+    accesstoken = await get_session_token()
+    status, data = await _http_request("POST", url, data=json.dumps({'accesstoken': accesstoken, **(payload or {})}))
+    if status == 401:
+        logging.info('Access token rejected, logging in again...')
+        invalidate_session(accesstoken)
+        accesstoken = await get_session_token()
+        status, data = await _http_request("POST", url, data=json.dumps({'accesstoken': accesstoken, **(payload or {})}))
+    return status, data
+
+
+async def get_shop_items():
+    """Retrieve the shop items from the API, see vf_data.get_shop_items()."""
+    logging.info('getting shop_items...')
+    try:
+        status, data = await post_with_session(_api_url + "interface/rest/articles/list")
+        if status != 200:
+            raise ConnectionError("Server returned " + str(status))
+        return data
+    except ConnectionError:
+        logging.error("Error while getting shop_items")
+        CON_ERRORS.inc(operation="get_shop_items")
+        return CON_ERROR
+
+
+def _fetch_catalog_items():
+    # Called by the shared cache on an executor thread; the request itself is sent on the event loop
+    return checked_catalog_items(asyncio.run_coroutine_threadsafe(get_shop_items(), _loop).result())
+
+
+def _use_shared_catalog(entry):
+    """Swap in the shared catalog entry if it differs from the current snapshot."""
+    global _catalog
+    _catalog = catalog_for_entry(_catalog, entry)
+
+
+async def refresh_catalog(max_age=0):
+    """
+    Download the catalog unless the shared cache holds one that is at most `max_age` seconds old,
+    see vf_data.refresh_catalog(). Only one broker process on the host downloads at a time.
+
+    Raises:
+        ConnectionError: If the download fails. The current snapshot is kept.
+
+    Returns:
+        CatalogSnapshot: The current snapshot.
+    """
+    global _catalog_checked
+    try:
+        # In the context of the caller, so a download started by a request shows up in its trace
+        entry = await _loop.run_in_executor(None, functools.partial(
+            contextvars.copy_context().run, _shared.get_or_fetch, "catalog", max_age, _fetch_catalog_items))
+    except (ConnectionError, TimeoutError) as e:
+        CATALOG_LOOKUPS.inc(result="refresh_error")
+        raise ConnectionError(str(e)) from e
+    _use_shared_catalog(entry)
+    _catalog_checked = time.monotonic()
+    return _catalog
+
+
+async def _refresh_catalog_on_request():
+    try:
+        return await refresh_catalog(CACHE_TTL)
+    except ConnectionError as e:
+        logging.error("Error fetching shop items (%s). Returning cached data if available.", e)
+        return _catalog
+
+
+async def _check_shared_catalog():
+    """Pick up a catalog another broker process (e.g. the scheduler of main.py) stored in the meantime."""
+    global _catalog_checked
+    _catalog_checked = time.monotonic()
+    updated_at = await _loop.run_in_executor(None, _shared.updated_at, "catalog")
+    if updated_at is not None and (_catalog is None or updated_at != _catalog.timestamp):
+        entry = await _loop.run_in_executor(None, _shared.get, "catalog")
+        if entry is not None:
+            _use_shared_catalog(entry)
+
+
+async def get_catalog():
+    """
+    Return the current catalog snapshot, refreshing it when it is older than CACHE_TTL.
+
+    While a refresh is running, requests get the previous snapshot; only requests without any
+    snapshot await the refresh task. Every SHARED_CHECK_INTERVAL seconds a request checks whether
+    the shared cache holds a newer catalog.
+
+    While the catalog scheduler runs (see start_catalog_scheduler), requests never download the
+    catalog themselves, as in vf_data.get_catalog().
+    """
+    global _catalog_task
+    snapshot = _catalog
+    if snapshot is not None and snapshot.age() < CACHE_TTL:
+        CATALOG_LOOKUPS.inc(result="hit")
+        if time.monotonic() - _catalog_checked >= SHARED_CHECK_INTERVAL:
+            await _check_shared_catalog()
+        return _catalog
+    CATALOG_LOOKUPS.inc(result="stale" if snapshot is not None else "miss")
+    if _catalog_scheduler is not None and not _catalog_scheduler.done():
+        if snapshot is None:
+            await _check_shared_catalog()
+        return _catalog
+    if _catalog_task is None or _catalog_task.done():
+        _catalog_task = asyncio.ensure_future(_refresh_catalog_on_request())
+    if snapshot is not None:
+        return snapshot
+    return await asyncio.shield(_catalog_task)
+
+
+async def _run_catalog_scheduler():
+    # Warm-up: a catalog another broker process or the previous run stored recently is good enough
+    max_age = CATALOG_REFRESH_INTERVAL
+    while True:
+        started = time.time()
+        try:
+            snapshot, error = await refresh_catalog(max_age), None
+        except Exception as e:
+            # The task must keep running whatever the download fails with
+            snapshot, error = None, e
+        wait, max_age = scheduled_refresh_done(started, snapshot, error)
+        await asyncio.sleep(wait)
+
+
+def start_catalog_scheduler():
+    """
+    Start the task that downloads the catalog right away, every CATALOG_REFRESH_INTERVAL seconds
+    and CATALOG_ROLLOVER_LEAD seconds before midnight, see vf_data.start_catalog_scheduler().
+    Must be called on the serving event loop after start().
+    """
+    global _catalog_scheduler
+    if _catalog_scheduler is not None and not _catalog_scheduler.done():
+        return
+    _catalog_scheduler = asyncio.ensure_future(_run_catalog_scheduler())
+
+
+async def get_shop_items_cached():
+    snapshot = await get_catalog()
+    if snapshot is None:
+        CON_ERRORS.inc(operation="get_shop_items_cached")
+        return CON_ERROR
+    return snapshot.items
+
+
+async def get_fu_products():
+    snapshot = await get_catalog()
+    return snapshot.fu_items if snapshot is not None else {}
+
+
+async def get_valid_fu_products():
+    snapshot = await get_catalog()
+    return snapshot.valid_fu_items() if snapshot is not None else {}
+
+
+async def get_catalog_json(view):
+    """Return a catalog view as JSON body and content hash, or None if there is no catalog."""
+    snapshot = await get_catalog()
+    if snapshot is None:
+        CON_ERRORS.inc(operation="get_catalog_json")
+        return None
+    return snapshot.serialized(view)
+
+
+async def get_row_map():
+    snapshot = await get_catalog()
+    return snapshot.row_map() if snapshot is not None else {}
+
+
+async def get_product_for_row(row):
+    return (await get_row_map()).get(str(row))
+
+
+async def submit_sale(sale):
+    """
+    Book one journaled sale at Vereinsflieger, see vf_data.submit_sale().
+
+    Raises:
+    ConnectionError: If the server responds with a status code other than 200.
+    """
+    comment = "Automatisch gebucht"
+    if sale.get("id") is not None:
+        comment += " (#" + str(sale["id"]) + ")"
+    payload = {
+        'articleid': sale["articleid"],
+        'bookingdate': sale["bookingdate"],
+        'amount': sale["amount"],
+        'memberid': int(sale["memberid"]),
+        'comment': comment,
+    }
+    try:
+        status, data = await post_with_session(_api_url + "interface/rest/sale/add", payload)
+        if status != 200:
+            raise ConnectionError("Server returned " + str(status))
+    except ConnectionError:
+        SALE_SUBMISSIONS.inc(result="error")
+        raise
+    SALE_SUBMISSIONS.inc(result="ok")
+    return data
+
+
+def _submit_from_journal(sale):
+    # Runs on the journal's thread; the request itself is sent on the event loop, in this thread's trace
+    submit_traced(lambda sale: asyncio.run_coroutine_threadsafe(submit_sale(sale), _loop).result(), sale)
+
+
+_sale_journal = SaleJournal(SALE_JOURNAL_FILE, _submit_from_journal)
+
+
+async def record_sale(buyer, amount, item):
+    """Write a sale to the sale journal (in a worker thread, it waits for fsync) and return its journal ID."""
+    trace = tracing.current()
+    request_id = trace.id if trace is not None else None
+    return await _loop.run_in_executor(
+        None, lambda: _sale_journal.append(buyer["memberid"], item["articleid"], amount,
+                                           datetime.now().date().isoformat(), request_id=request_id))
+
+
+async def book_cart(buyer, lines):
+    """
+    Journal the lines of a cart and book them at Vereinsflieger right away, see vf_data.book_cart().
+
+    Returns:
+        list: One dict per line with the journal ID ("saleid"), "booked" and, if not booked, "error".
+    """
+    trace = tracing.current()
+    request_id = trace.id if trace is not None else None
+    bookingdate = datetime.now().date().isoformat()
+    sales = await _loop.run_in_executor(None, lambda: _sale_journal.append_claimed(
+        [(buyer["memberid"], item["articleid"], amount, bookingdate) for item, amount in lines],
+        request_id=request_id))
+    try:
+        # Log in once up front instead of letting the parallel submissions wait for each other
+        await get_session_token()
+    except ConnectionError as e:
+        logging.warning("Login before booking cart failed: %s", e)
+    # The journal's submission threads send the requests on the event loop (see _submit_from_journal)
+    errors = await _loop.run_in_executor(
+        None, functools.partial(_sale_journal.submit_claimed, sales, CART_PARALLELISM))
+    return [
+        {"saleid": sale["id"], "booked": error is None, **({"error": error} if error else {})}
+        for sale, error in zip(sales, errors)
+    ]
+
+
+async def get_sale_queue_depth():
+    return await _loop.run_in_executor(None, _sale_journal.queue_depth)
+
+
+def get_user_info(keyname):
+    user = _member_index.lookup(keyname)
+    if user is not None:
+        MEMBER_LOOKUPS.inc(index="keyname", result="hit")
+        return user
+    MEMBER_LOOKUPS.inc(index="keyname", result="miss")
+    return {"message": "User not found"}
+
+
+def get_member_index_stats():
+    return _member_index.stats()
+
+
+metrics.gauge("broker_catalog_age_seconds", "Age of the cached shop items.",
+              lambda: _catalog.age() if _catalog is not None else None)
+metrics.gauge("broker_member_index_entries", "Keynames in the RFID member index.",
+              lambda: _member_index.stats()["keys"])
+metrics.gauge("broker_sale_queue_depth", "Journaled sales by state.",
+              lambda: {(("state", state),): count for state, count in _sale_journal.queue_depth().items()})
@@ -0,0 +1,135 @@
+"""
+Micro-benchmarks for the hot paths of broker/vf_data.py against the Vereinsflieger stub.
+
+Starts vf_stub in-process, points vf_data at it (in a temporary data directory) and measures
+throughput and latency percentiles per function.
+
+Usage:
+    python broker/bench/bench_vf_data.py --iterations 2000 --threads 4 --latency 50
+    python broker/bench/bench_vf_data.py --only get_valid_fu_products --json > result.json
+"""
+import argparse
+import atexit
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import vf_stub
+from stats import print_table, summarize
+
+BROKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_vf_data(state, api_url):
+    """Prepare a temporary data directory and environment, then import vf_data."""
+    data_root = tempfile.mkdtemp(prefix="vf_bench_")
+    atexit.register(shutil.rmtree, data_root, ignore_errors=True)
+    os.makedirs(os.path.join(data_root, "data"))
+    with open(os.path.join(data_root, "data", "token.json"), "w") as f:
+        json.dump(state.members, f)
+    os.chdir(data_root)
+    os.environ.update({
+        "API_URL": api_url,
+        "API_TOKEN": "bench",
+        "API_USERNAME": "bench",
+        "API_PASSWORD": "bench",
+        "API_CID": "1",
+    })
+    sys.path.insert(0, BROKER_DIR)
+    import vf_data  # pylint: disable=import-outside-toplevel
+    return vf_data
+
+
+def make_cases(vf_data, state):
+    keynames = [member["keymanagement"][0]["keyname"] for member in state.members]
+    names = [(member["firstname"], member["lastname"]) for member in state.members]
+    item = next(iter(vf_data.get_valid_fu_products().values()))
+    buyer = {"memberid": state.members[0]["memberid"]}
+    return {
+        "get_shop_items_cached": vf_data.get_shop_items_cached,
+        "get_fu_products": vf_data.get_fu_products,
+        "get_valid_fu_products": vf_data.get_valid_fu_products,
+        "get_row_map": vf_data.get_row_map,
+        "get_user_info": lambda: vf_data.get_user_info(random.choice(keynames)),
+        "get_vfid": lambda: vf_data.get_vfid(*random.choice(names)),
+        "record_sale": lambda: vf_data.record_sale(buyer, 1, item),
+        "set_new_sale": lambda: vf_data.set_new_sale(buyer, 1, item),
+    }
+
+
+def measure(name, function, iterations, threads):
+    """Call `function` `iterations` times spread over `threads` threads and summarize the latencies."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_thread = max(1, iterations // threads)
+
+    def worker():
+        local_latencies = []
+        local_errors = 0
+        for _ in range(per_thread):
+            start = time.perf_counter()
+            try:
+                result = function()
+            except Exception:  # pylint: disable=broad-except
+                local_errors += 1
+                continue
+            elapsed = time.perf_counter() - start
+            if result == "Connection error":
+                local_errors += 1
+            else:
+                local_latencies.append(elapsed)
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return summarize(name, latencies, errors[0], time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=1000, help="calls per function")
+    parser.add_argument("--upstream-iterations", type=int, default=100,
+                        help="calls for functions that hit the stub on every call (set_new_sale)")
+    parser.add_argument("--threads", type=int, default=1, help="concurrent callers")
+    parser.add_argument("--only", action="append", help="only run the named function (repeatable)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    vf_stub.add_arguments(parser)
+    args = parser.parse_args()
+
+    state = vf_stub.state_from_args(args)
+    _, api_url = vf_stub.start_stub(state)
+    vf_data = setup_vf_data(state, api_url)
+
+    # Warm up: first login, catalog download and member index load are not part of the measurement
+    vf_data.get_valid_fu_products()
+    vf_data.get_user_info("")
+    vf_data.get_vfid("", "")
+
+    results = []
+    for name, function in make_cases(vf_data, state).items():
+        if args.only and name not in args.only:
+            continue
+        iterations = args.upstream_iterations if name == "set_new_sale" else args.iterations
+        results.append(measure(name, function, iterations, args.threads))
+
+    if args.json:
+        print(json.dumps({"config": vars(args), "upstream_calls": state.calls, "results": results}, indent=2))
+    else:
+        print_table(results)
+        print(f"\nUpstream calls: {json.dumps(state.calls)}")
+
+
+if __name__ == "__main__":
+    main()
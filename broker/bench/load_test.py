@@ -0,0 +1,219 @@
+"""
+Load generator for the broker: simulates several kiosks against one broker.
+
+Every simulated kiosk repeats the session flow of the snack machine:
+badge tap (/getUserInfo), catalog fetch (/getValidFUProducts) and buy (/Buy), with a think
+time between the steps. Requests are authenticated with the same JWT scheme as
+local/backend/api_caller.py. Throughput, p50/p95/p99 latency and error rate are reported per endpoint.
+
+Usage against a running broker (RFIDs must exist in its data/token.json):
+    JWT_SECRET_KEY=... python broker/bench/load_test.py --broker https://127.0.0.1:8124 \\
+        --kiosks 5 --duration 60 --rfid 1234
+
+Usage with a broker and Vereinsflieger stub started for the test:
+    python broker/bench/load_test.py --spawn --kiosks 20 --duration 30 --latency 80
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import jwt
+import requests
+import urllib3
+
+import vf_stub
+from stats import print_table, summarize
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BROKER_DIR = os.path.dirname(BENCH_DIR)
+
+BROKER_SCRIPT = """
+import main
+main.start_background_tasks()
+main.app.run(host="127.0.0.1", port={port}, threaded=True, ssl_context="adhoc")
+"""
+
+
+class Recorder:
+    """Collects latencies and errors per endpoint from all kiosk threads."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            if ok:
+                self.latencies.setdefault(endpoint, []).append(seconds)
+            else:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, elapsed):
+        endpoints = sorted(set(self.latencies) | set(self.errors))
+        return [summarize(endpoint, self.latencies.get(endpoint, []), self.errors.get(endpoint, 0), elapsed)
+                for endpoint in endpoints]
+
+
+class Kiosk(threading.Thread):
+    """One simulated snack machine."""
+
+    def __init__(self, number, args, recorder, stop):
+        super().__init__(name=f"kiosk-{number}", daemon=True)
+        self.args = args
+        self.recorder = recorder
+        self.stop = stop
+        self.session = requests.Session()
+        self.headers = {}
+
+    def auth_headers(self, subject):
+        # Same claims as api_caller.get_auth_headers(), one token per subject and kiosk
+        if subject not in self.headers:
+            payload = {"sub": subject, "name": "Frontend", "iat": datetime.datetime.utcnow()}
+            token = jwt.encode(payload, self.args.secret, algorithm="HS256")
+            self.headers[subject] = {"Authorization": f"Bearer {token}"}
+        return self.headers[subject]
+
+    def call(self, method, endpoint, subject, body=None):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.args.broker + endpoint, json=body,
+                                            headers=self.auth_headers(subject), timeout=self.args.timeout,
+                                            verify=not self.args.insecure)
+            ok = response.status_code < 400
+            data = response.json() if ok else None
+        except (requests.RequestException, ValueError):
+            ok, data = False, None
+        self.recorder.record(endpoint, time.perf_counter() - start, ok)
+        return data
+
+    def think(self):
+        self.stop.wait(random.uniform(0, 2 * self.args.think_time / 1000))
+
+    def run(self):
+        while not self.stop.is_set():
+            user = self.call("POST", "/getUserInfo", "get_user_by_rfid", {"rfid_id": random.choice(self.args.rfid)})
+            self.think()
+            products = self.call("GET", "/getValidFUProducts", "get_valid_products")
+            self.think()
+            if isinstance(user, dict) and user.get("memberid") and isinstance(products, dict) and products:
+                itemid = random.choice(list(products))
+                self.call("POST", "/Buy", "set_new_sale", {"memberid": user["memberid"], "itemid": itemid, "amount": 1})
+            self.think()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode} before listening on port {port}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout} seconds")
+
+
+def spawn(args):
+    """Start a Vereinsflieger stub and a broker wired to it, each as a subprocess."""
+    workdir = tempfile.mkdtemp(prefix="broker_load_")
+    os.makedirs(os.path.join(workdir, "data"))
+    stub_port, broker_port = free_port(), free_port()
+    stub_args = [sys.executable, os.path.join(BENCH_DIR, "vf_stub.py"), "--port", str(stub_port),
+                 "--articles", str(args.articles), "--members", str(args.members),
+                 "--latency", str(args.latency), "--jitter", str(args.jitter),
+                 "--error-rate", str(args.error_rate), "--token-ttl", str(args.token_ttl),
+                 "--write-members", os.path.join(workdir, "data", "token.json")]
+    env = dict(os.environ, PYTHONPATH=BROKER_DIR, JWT_SECRET_KEY=args.secret,
+               API_URL=f"http://127.0.0.1:{stub_port}/", API_TOKEN="load", API_USERNAME="load",
+               API_PASSWORD="load", API_CID="1")
+    stub = subprocess.Popen(stub_args, cwd=workdir, stdout=subprocess.DEVNULL)
+    broker = subprocess.Popen([sys.executable, "-c", BROKER_SCRIPT.format(port=broker_port)], cwd=workdir,
+                              env=env, stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, "broker.log"), "w"))
+    processes = [stub, broker]
+    try:
+        wait_for_port(stub_port, stub)
+        wait_for_port(broker_port, broker)
+    except RuntimeError:
+        for process in processes:
+            process.terminate()
+        with open(os.path.join(workdir, "broker.log")) as log:
+            sys.stderr.write(log.read())
+        raise
+    args.broker = f"https://127.0.0.1:{broker_port}"
+    args.insecure = True
+    args.rfid = [member["keymanagement"][0]["keyname"] for member in vf_stub.make_members(args.members)]
+    return processes, workdir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", help="broker base URL, e.g. https://127.0.0.1:8124")
+    parser.add_argument("--secret", default=os.environ.get("JWT_SECRET_KEY"), help="JWT secret of the broker")
+    parser.add_argument("--rfid", action="append", help="RFID keyname used for badge taps (repeatable)")
+    parser.add_argument("--kiosks", type=int, default=5, help="number of simulated kiosks")
+    parser.add_argument("--duration", type=float, default=30, help="test duration in seconds")
+    parser.add_argument("--think-time", type=float, default=500, help="mean pause between steps in ms")
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout in seconds")
+    parser.add_argument("--insecure", action="store_true", help="do not verify the broker certificate")
+    parser.add_argument("--spawn", action="store_true", help="start a stub and a broker for the test")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    vf_stub.add_arguments(parser)
+    args = parser.parse_args()
+
+    processes, workdir = [], None
+    if args.spawn:
+        args.secret = args.secret or secrets.token_hex(32)
+        processes, workdir = spawn(args)
+    elif not args.broker or not args.secret or not args.rfid:
+        parser.error("--broker, --secret (or JWT_SECRET_KEY) and --rfid are required without --spawn")
+    if args.insecure:
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    recorder = Recorder()
+    stop = threading.Event()
+    kiosks = [Kiosk(number, args, recorder, stop) for number in range(args.kiosks)]
+    start = time.perf_counter()
+    try:
+        for kiosk in kiosks:
+            kiosk.start()
+        stop.wait(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for kiosk in kiosks:
+            kiosk.join(args.timeout)
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    results = recorder.summary(time.perf_counter() - start)
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key not in ("secret", "rfid")}
+        print(json.dumps({"config": config, "results": results}, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
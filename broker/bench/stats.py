@@ -0,0 +1,44 @@
+"""Latency statistics shared by the benchmark and load test scripts."""
+import math
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(name, latencies, errors, elapsed):
+    """
+    Summarize the latencies (in seconds) of one measured operation.
+
+    Returns:
+        dict: name, count, errors, error_rate, throughput (ops/s) and p50/p95/p99/max in milliseconds.
+    """
+    values = sorted(latencies)
+    total = len(values) + errors
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        "name": name,
+        "count": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "throughput": round(total / elapsed, 1) if elapsed > 0 else None,
+        "p50_ms": ms(percentile(values, 0.50)),
+        "p95_ms": ms(percentile(values, 0.95)),
+        "p99_ms": ms(percentile(values, 0.99)),
+        "max_ms": ms(values[-1] if values else None),
+    }
+
+
+def print_table(rows):
+    columns = ["name", "count", "errors", "error_rate", "throughput", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(str(row[column]).ljust(widths[column]) for column in columns))
@@ -0,0 +1,211 @@
+"""
+Stub of the Vereinsflieger REST API for benchmarks and load tests.
+
+Implements the endpoints the broker uses (auth/accesstoken, auth/signin, articles/list,
+user/list, sale/add) with a generated catalog and member list, configurable latency and
+error rate. It only uses the standard library.
+
+Usage:
+    python broker/bench/vf_stub.py --port 8099 --articles 200 --members 500 --latency 80
+
+Then start the broker with API_URL=http://127.0.0.1:8099/
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_articles(count):
+    """Generate `count` articles; every second one is a snack machine article tagged with a row."""
+    articles = {}
+    for i in range(count):
+        item_id = str(30000 + i)
+        if i % 2 == 0:
+            row = i // 2 + 1
+            articleid = f"Snackautomat Reihe {row}"
+            designation = f"Snack {row} [{row}]"
+        else:
+            articleid = f"FU_{i}"
+            designation = f"Artikel {i}"
+        articles[item_id] = {
+            "articleid": articleid,
+            "designation": designation,
+            "unittype": "Stück",
+            "costtype": "",
+            "spid": "0",
+            "account": "1234",
+            "prices": [
+                {"validfrom": "2020-01-01", "validto": "2020-12-31", "salestax": "19.00", "unitprice": "1.50"},
+                {"validfrom": "2021-01-01", "validto": "9999-12-31", "salestax": "19.00", "unitprice": "2.00"},
+            ],
+        }
+    return articles
+
+
+def make_members(count):
+    """Generate `count` members, each with one RFID key named "RFID<memberid>"."""
+    return [
+        {
+            "uid": str(100000 + i),
+            "title": "",
+            "firstname": f"Vorname{i}",
+            "lastname": f"Nachname{i}",
+            "memberid": str(1000 + i),
+            "keymanagement": [
+                {"title": "RFID-Transponder", "keyname": f"RFID{1000 + i}", "rfidkey": "1"},
+            ],
+        }
+        for i in range(count)
+    ]
+
+
+class StubState:
+    """Data and behaviour of one stub instance."""
+
+    def __init__(self, articles=200, members=500, latency=0.0, jitter=0.0, error_rate=0.0, token_ttl=3600):
+        self.articles = make_articles(articles)
+        self.members = make_members(members)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.tokens = {}  # accesstoken -> (signed in, issued at)
+        self.sales = []
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    state = None  # set by make_server()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        state = self.state
+        endpoint = self.path.split("interface/rest/", 1)[-1].strip("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        state.count(endpoint)
+        delay = state.latency + random.uniform(0, state.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < state.error_rate:
+            self._reply(500, {"error": "stub error"})
+            return
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            self._reply(400, {"error": "invalid json"})
+            return
+
+        if endpoint == "auth/accesstoken":
+            token = uuid.uuid4().hex
+            with state.lock:
+                state.tokens[token] = (False, time.time())
+            self._reply(200, {"accesstoken": token})
+            return
+        token = payload.get("accesstoken")
+        with state.lock:
+            signed_in, issued_at = state.tokens.get(token, (False, 0.0))
+        if endpoint == "auth/signin":
+            if token not in state.tokens:
+                self._reply(401, {"error": "unknown accesstoken"})
+                return
+            with state.lock:
+                state.tokens[token] = (True, time.time())
+            self._reply(200, {"httpstatuscode": 200})
+            return
+        if not signed_in or time.time() - issued_at > state.token_ttl:
+            self._reply(401, {"error": "not signed in"})
+            return
+        if endpoint == "articles/list":
+            self._reply(200, state.articles)
+        elif endpoint == "user/list":
+            self._reply(200, {"users": state.members})
+        elif endpoint == "sale/add":
+            with state.lock:
+                state.sales.append(payload)
+            self._reply(200, {"httpstatuscode": 200})
+        else:
+            self._reply(404, {"error": "unknown endpoint"})
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(state, host="127.0.0.1", port=0):
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def start_stub(state, host="127.0.0.1", port=0):
+    """
+    Start a stub server in a daemon thread.
+
+    Returns:
+        tuple: The server and its base URL (with trailing slash, as API_URL expects).
+    """
+    server = make_server(state, host, port)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="vf-stub", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+
+def add_arguments(parser):
+    parser.add_argument("--articles", type=int, default=200, help="number of articles in the catalog")
+    parser.add_argument("--members", type=int, default=500, help="number of members")
+    parser.add_argument("--latency", type=float, default=0.0, help="added latency per call in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency per call in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 500")
+    parser.add_argument("--token-ttl", type=float, default=3600, help="seconds until an accesstoken is rejected")
+
+
+def state_from_args(args):
+    return StubState(articles=args.articles, members=args.members, latency=args.latency / 1000,
+                     jitter=args.jitter / 1000, error_rate=args.error_rate, token_ttl=args.token_ttl)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--write-members", metavar="PATH",
+                        help="also write the members as token.json to PATH, for /getUserInfo")
+    add_arguments(parser)
+    args = parser.parse_args()
+    state = state_from_args(args)
+    if args.write_members:
+        with open(args.write_members, "w") as f:
+            json.dump(state.members, f)
+    server = make_server(state, args.host, args.port)
+    print(f"Vereinsflieger stub listening on http://{args.host}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
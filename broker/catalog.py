@@ -0,0 +1,149 @@
+import hashlib
+import json
+import re
+import time
+from datetime import date, datetime, timedelta
+
+FU_PREFIX = "Snackautomat Reihe "
+ROW_TAG = re.compile(r"\[([^\]]+)\]")  # Machine row tag in the designation, e.g. "Mars [3]"
+VIEWS = ("items", "fu_items", "valid_fu_items")
+
+
+class CatalogSnapshot:
+    """
+    One downloaded Vereinsflieger article list together with the views the broker serves from it.
+
+    The price validity windows of the FU articles are parsed once into an interval index. The set of
+    articles valid today, and the map from machine row to the article tagged for it, are computed from
+    that index and kept until the next midnight, so serving them only costs a timestamp comparison.
+
+    Apart from replacing that precomputed set, a snapshot is never modified after it has been built.
+    A refresh builds a new snapshot and swaps the module reference in vf_data, so readers can hand out
+    the contained dicts without copying them. Callers must treat every returned dict as read-only.
+
+    Every view can also be served pre-serialized with serialized(), together with a hash of its
+    content for use as ETag. Since the hash only depends on the content, a refresh that downloads an
+    unchanged article list keeps the ETags of the previous snapshot.
+
+    Attributes:
+        items (dict): The article list as returned by interface/rest/articles/list.
+        fu_items (dict): The articles whose articleid starts with FU_PREFIX.
+        timestamp (float): Time of the download as returned by time.time().
+    """
+    __slots__ = ("items", "fu_items", "timestamp", "_windows", "_valid", "_serialized")
+
+    def __init__(self, items, timestamp):
+        self.items = items
+        self.timestamp = timestamp
+        self.fu_items = {
+            item_id: details
+            for item_id, details in items.items()
+            if isinstance(details, dict) and details.get("articleid", "").startswith(FU_PREFIX)
+        }
+        self._windows = _build_validity_index(self.fu_items)
+        self._valid = (0.0, {}, {}, None)
+        self._serialized = {}
+
+    def age(self):
+        """Seconds since the article list was downloaded."""
+        return time.time() - self.timestamp
+
+    def valid_fu_items(self):
+        """
+        Return the FU articles that have a price valid today, with only those prices.
+
+        The result is recomputed from the interval index only once the precomputed rollover
+        time, the next local midnight, has passed.
+
+        Returns:
+            dict: Item ID to article details, with "prices" reduced to the prices valid today.
+        """
+        return self._valid_today()[1]
+
+    def row_map(self):
+        """
+        Return the valid articles by machine row.
+
+        The row is taken from the tags in square brackets in the designation, e.g. "Mars [3]"
+        is row "3". If several valid articles are tagged with the same row, the first one wins.
+
+        Returns:
+            dict: Row (str) to article details as returned by valid_fu_items().
+        """
+        return self._valid_today()[2]
+
+    def serialized(self, view):
+        """
+        Return a view as JSON body and its content hash.
+
+        Parameters:
+            view (str): One of VIEWS: "items", "fu_items" or "valid_fu_items".
+
+        Returns:
+            tuple: The UTF-8 encoded JSON body and the hex digest of its SHA-256 hash.
+        """
+        if view not in VIEWS:
+            raise ValueError(f"Unknown catalog view {view}")
+        if view == "valid_fu_items":
+            valid = self._valid_today()
+            if valid[3] is None:
+                # Serialized on first use, dropped with the rest of the tuple at the rollover
+                self._valid = valid = valid[:3] + (_serialize(valid[1]),)
+            return valid[3]
+        serialized = self._serialized.get(view)
+        if serialized is None:
+            serialized = self._serialized[view] = _serialize(getattr(self, view))
+        return serialized
+
+    def _valid_today(self):
+        """Return (valid_until, valid_items, row_map, serialized), recomputing them after the rollover time."""
+        valid = self._valid
+        if time.time() < valid[0]:
+            return valid
+        today = date.today()
+        valid_items = {}
+        rows = {}
+        for item_id, details, windows in self._windows:
+            valid_prices = [price for valid_from, valid_to, price in windows if valid_from <= today <= valid_to]
+            if valid_prices:
+                valid_items[item_id] = {**details, "prices": valid_prices}
+                for row in ROW_TAG.findall(details.get("designation", "")):
+                    rows.setdefault(row, valid_items[item_id])
+        valid = (_next_midnight(today), valid_items, rows, None)
+        self._valid = valid
+        return valid
+
+
+def _build_validity_index(fu_items):
+    """
+    Parse the price validity windows of all articles once.
+
+    Returns:
+        list: One (item_id, details, [(valid_from, valid_to, price), ...]) tuple per article
+        that has at least one parseable price.
+    """
+    windows = []
+    for item_id, details in fu_items.items():
+        item_windows = []
+        for price in details.get("prices", []):
+            try:
+                valid_from = datetime.strptime(str(price["validfrom"]), "%Y-%m-%d").date()
+                valid_to = datetime.strptime(price["validto"], "%Y-%m-%d").date()
+            except (KeyError, TypeError, ValueError):
+                # Skip entries with invalid or incomplete dates
+                continue
+            item_windows.append((valid_from, valid_to, price))
+        if item_windows:
+            windows.append((item_id, details, item_windows))
+    return windows
+
+
+def _serialize(data):
+    """Serialize a view deterministically, so equal content gives the same body and hash."""
+    body = json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+    return body, hashlib.sha256(body).hexdigest()
+
+
+def _next_midnight(today):
+    """Timestamp of the local midnight that ends the given day."""
+    return datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
@@ -0,0 +1,16 @@
+# gunicorn configuration for the broker, see wsgi.py
+import multiprocessing
+import os
+
+bind = os.getenv("BROKER_BIND", "0.0.0.0:8124")
+workers = int(os.getenv("BROKER_WORKERS", multiprocessing.cpu_count()))
+# Threads per worker; requests waiting on Vereinsflieger block a thread, not the whole worker
+threads = int(os.getenv("BROKER_THREADS", 8))
+timeout = 120
+
+# Every worker imports the app itself, so no SQLite connection or background thread crosses a fork
+preload_app = False
+
+if os.path.exists("data/cert.pem") and os.path.exists("data/key.pem"):
+    certfile = "data/cert.pem"
+    keyfile = "data/key.pem"
@@ -1,10 +1,15 @@
 import tempfile
-from flask import Flask, request
+import time
+from flask import Flask, Response, g, request
 from flask_jwt_extended import JWTManager, jwt_required
 from flask_talisman import Talisman
 import logging
 from werkzeug.serving import make_ssl_devcert
 import vf_data
+import admin_auth
+from sale_journal import valid_amount, valid_memberid
+import metrics
+import tracing
 import os
 app = Flask(__name__, static_url_path='/static')
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
@@ -12,20 +17,87 @@ app.config['JWT_ACCESS_TOKEN_EXPIRES'] = False
 jwt = JWTManager(app)
 Talisman(app)
 
+REQUEST_SECONDS = metrics.histogram(
+    "broker_http_request_duration_seconds", "Duration of broker requests by route, method and status.")
+
+MAX_CART_LINES = 20
+
+# Routes that are polled by monitoring and not worth a trace
+UNTRACED_ROUTES = {'/metrics', '/traces', '/traces/<trace_id>'}
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    tracing.set_current(tracing.Trace(request.path, request.headers.get(tracing.HEADER)))
+
+@app.after_request
+def observe_request(response):
+    started = g.pop('request_started', None)
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method,
+                                status=str(response.status_code))
+    trace = tracing.current()
+    if trace is not None:
+        response.headers[tracing.HEADER] = trace.id
+        if trace.stages:
+            response.headers['Server-Timing'] = trace.server_timing()
+        if route not in UNTRACED_ROUTES:
+            tracing.finish(trace, method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def clear_trace(exc=None):
+    tracing.set_current(None)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/traces', methods=['GET'])
+@jwt_required()
+def get_traces():
+    limit = request.args.get('limit', default=50, type=int)
+    return {"traces": [trace.to_dict() for trace in tracing.buffer.recent(limit)]}
+
+@app.route('/traces/<trace_id>', methods=['GET'])
+@jwt_required()
+def get_trace(trace_id):
+    traces = tracing.buffer.find(trace_id)
+    if not traces:
+        return {"message": "Unknown trace"}, 404
+    return {"traces": [trace.to_dict() for trace in traces]}
+
+def catalog_response(view, fallback):
+    """
+    Answer with a pre-serialized catalog view and its content hash as ETag.
+
+    A request whose If-None-Match matches the ETag gets an empty 304 response, so a kiosk
+    polling an unchanged catalog does not download it again.
+    """
+    catalog_json = vf_data.get_catalog_json(view)
+    if catalog_json is None:
+        return fallback
+    body, etag = catalog_json
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
 @app.route('/getAllProducts', methods=['GET'])
 @jwt_required()
 def get_all_products():
-    return vf_data.get_shop_items()
+    return catalog_response("items", vf_data.CON_ERROR)
 
 @app.route('/getFUProducts', methods=['GET'])
 @jwt_required()
 def get_fu_products():
-    return vf_data.get_fu_products()
+    return catalog_response("fu_items", {})
 
 @app.route('/getValidFUProducts', methods=['GET'])
 @jwt_required()
 def get_valid_f_products():
-    return vf_data.get_valid_fu_products()
+    return catalog_response("valid_fu_items", {})
 
 
 @app.route('/test', methods=['GET'])
@@ -36,10 +108,16 @@ def test():
 @app.route('/Buy', methods=['POST'])
 @jwt_required()
 def test_buy():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return {"message": "Expected a JSON object"}, 400
     memberid = data.get('memberid')
     itemid = data.get('itemid')
     amount = data.get('amount')
+    if not valid_memberid(memberid):
+        return {"message": "Invalid memberid"}, 400
+    if not valid_amount(amount):
+        return {"message": "Invalid amount"}, 400
     buyer = {
         "memberid": memberid,
     }
@@ -47,28 +125,105 @@ def test_buy():
     # Check if the requested item is in the list of valid items
     valid_item = valid_items.get(itemid)
     if valid_item:
-        response = vf_data.set_new_sale(buyer, amount, valid_item)
-        return response
+        # The sale is journaled and booked upstream in the background
+        saleid = vf_data.record_sale(buyer, amount, valid_item)
+        return {"message": "Sale recorded", "saleid": saleid}, 202
     else:
         return {"message": "Invalid item"}, 400
 
+@app.route('/BuyCart', methods=['POST'])
+@jwt_required()
+def buy_cart():
+    """
+    Buy several items for one member.
+
+    Body: {"memberid": "1234", "items": [{"itemid": "34722", "amount": 2}, ...]}
+
+    All lines are checked against the same catalog snapshot; if one is invalid, nothing is booked
+    and the per-line results tell which. Otherwise every line is journaled and booked right away.
+    Lines that could not be booked yet are retried in the background (status 202).
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return {"message": "Expected a JSON object"}, 400
+    memberid = data.get('memberid')
+    lines = data.get('items')
+    if not isinstance(lines, list) or not 0 < len(lines) <= MAX_CART_LINES:
+        return {"message": f"Expected a memberid and 1 to {MAX_CART_LINES} items"}, 400
+    if not valid_memberid(memberid):
+        return {"message": "Invalid memberid"}, 400
+    valid_items = vf_data.get_valid_fu_products()
+    results = []
+    cart = []
+    for line in lines:
+        line = line if isinstance(line, dict) else {}
+        itemid = line.get('itemid')
+        amount = line.get('amount', 1)
+        valid_item = valid_items.get(itemid)
+        if valid_item is None:
+            results.append({"itemid": itemid, "amount": amount, "message": "Invalid item"})
+        elif not valid_amount(amount):
+            results.append({"itemid": itemid, "amount": amount, "message": "Invalid amount"})
+        else:
+            results.append({"itemid": itemid, "amount": amount})
+            cart.append((valid_item, amount))
+    if len(cart) < len(lines):
+        return {"message": "Invalid cart", "lines": results}, 400
+    booked = vf_data.book_cart({"memberid": memberid}, cart)
+    for result, booking in zip(results, booked):
+        result.update(booking)
+        result["message"] = "Sale booked" if booking["booked"] else "Sale recorded"
+    all_booked = all(booking["booked"] for booking in booked)
+    return {"message": "Cart booked" if all_booked else "Cart recorded", "lines": results}, 200 if all_booked else 202
+
+@app.route('/admin/refreshCatalog', methods=['POST'])
+def refresh_catalog():
+    # Signed with ADMIN_JWT_SECRET_KEY, not with the kiosks' key (see admin_auth)
+    error = admin_auth.check(request.headers.get('Authorization'))
+    if error is not None:
+        message, status = error
+        return {"message": message}, status
+    try:
+        snapshot = vf_data.refresh_catalog()
+    except ConnectionError as e:
+        return {"message": f"Catalog refresh failed: {e}"}, 502
+    return {"message": "Catalog refreshed", "items": len(snapshot.items), "timestamp": snapshot.timestamp}
+
+@app.route('/getSaleQueue', methods=['GET'])
+@jwt_required()
+def get_sale_queue():
+    return vf_data.get_sale_queue_depth()
+
 @app.route('/getUserInfo', methods=['POST'])
 @jwt_required()
 def get_user_info():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return {"message": "Expected a JSON object"}, 400
     memberid = data.get('rfid_id')
     return vf_data.get_user_info(memberid)
 
+@app.route('/getMemberIndexStats', methods=['GET'])
+@jwt_required()
+def get_member_index_stats():
+    return vf_data.get_member_index_stats()
+
 @app.route('/getSpecificProduct', methods=['POST'])
 @jwt_required()
 def get_product():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return {"message": "Expected a JSON object"}, 400
     row = data.get('row')
-    valid_products = vf_data.get_valid_fu_products()
-    for product_id, product_details in valid_products.items():
-        if f'[{row}]' in product_details.get('designation', ''):
-            return product_details
-        return "False"
+    product = vf_data.get_product_for_row(row)
+    if product:
+        return product
+    return "False"
+
+@app.route('/getRowMap', methods=['GET'])
+@jwt_required()
+def get_row_map():
+    return vf_data.get_row_map()
 
 def ensure_ssl_certificates(cert_filename='data/cert.pem', key_filename='data/key.pem'):
     base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -95,7 +250,13 @@ def ensure_ssl_certificates(cert_filename='data/cert.pem', key_filename='data/ke
     logging.debug("Generated new self-signed SSL certificate at %s and key at %s", cert_path, key_path)
     return cert_path, key_path
 
+def start_background_tasks():
+    vf_data.start_catalog_scheduler()
+    vf_data.start_member_sync()
+    vf_data.start_sale_submission()
+
 if __name__ == '__main__':
+    start_background_tasks()
     if app.config['FLASK_ENV'] is True:
         logging.basicConfig(level=logging.DEBUG)
     #app.run(debug=True, host="0.0.0.0", port=8123)
@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+class MemberIndex:
+    """
+    In-memory index from RFID keyname to member record, built from the member file (data/token.json).
+
+    The file is parsed once and parsed again only when its inode, mtime or size changes. A reload
+    builds a complete new index and then replaces the old one with a single assignment, so readers
+    always see either the old or the new index, never a half-built one.
+
+    Attributes:
+        path (str): Path of the member file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # (file identity, keyname -> member, time of the load, number of members)
+        self._state = (None, {}, None, 0)
+
+    def lookup(self, keyname):
+        """Return the member record for the given keyname, or None if no member has that key."""
+        self._reload_if_changed()
+        return self._state[1].get(keyname)
+
+    def stats(self):
+        """Return the load time (time.time(), None if never loaded) and entry counts for monitoring."""
+        self._reload_if_changed()
+        _, by_keyname, loaded_at, members = self._state
+        return {"path": self.path, "loaded_at": loaded_at, "members": members, "keys": len(by_keyname)}
+
+    def _reload_if_changed(self):
+        file_id = self._file_id()
+        if file_id is None or file_id == self._state[0]:
+            return
+        with self._lock:
+            if file_id == self._state[0]:
+                return
+            try:
+                with open(self.path, 'r') as file:
+                    users = json.load(file)
+            except (OSError, ValueError) as e:
+                logging.error("Could not load member file %s, keeping the previous index: %s", self.path, e)
+                return
+            by_keyname = {}
+            for user in users:
+                for key in user.get('keymanagement', []):
+                    # The first member listed for a keyname wins, as with the previous linear scan.
+                    by_keyname.setdefault(key.get('keyname'), user)
+            self._state = (file_id, by_keyname, time.time(), len(users))
+            logging.info("Loaded %d members with %d keys from %s", len(users), len(by_keyname), self.path)
+
+    def _file_id(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class MemberDirectory:
+    """
+    Local copy of the Vereinsflieger member list (interface/rest/user/list), indexed by
+    (firstname, lastname) and by memberid.
+
+    The list is downloaded once on first use and then synced every `ttl` seconds, by a background
+    thread once start() was called, otherwise by the first lookup after the TTL. Only one sync runs
+    at a time; lookups during a sync are served from the previous copy.
+
+    The upstream API has no "changed since" query, so every sync downloads the whole list. The sync
+    compares it with the previous copy by memberid and only logs and swaps in the new indexes if
+    something changed.
+
+    Attributes:
+        ttl (float): Seconds between two syncs.
+    """
+
+    def __init__(self, fetch, ttl):
+        """
+        Parameters:
+        fetch (callable): Returns the list of member dicts from upstream, raises ConnectionError on failure.
+        ttl (float): Seconds between two syncs.
+        """
+        self._fetch = fetch
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._thread = None
+        # (time of the last sync attempt, (firstname, lastname) -> member, memberid -> member)
+        self._state = (None, {}, {})
+
+    def by_name(self, firstname, lastname):
+        """Return the member with the given first and last name, or None if there is none."""
+        return self._current()[1].get((firstname, lastname))
+
+    def by_memberid(self, memberid):
+        """Return the member with the given memberid, or None if there is none."""
+        return self._current()[2].get(str(memberid))
+
+    def stats(self):
+        """Return the time of the last sync (None if never synced) and the entry counts for monitoring."""
+        synced_at, by_name, by_memberid = self._state
+        return {"synced_at": synced_at, "members": len(by_memberid), "names": len(by_name)}
+
+    def sync(self):
+        """
+        Download the member list and replace the indexes if it changed.
+
+        Raises:
+        ConnectionError: If the download fails. The previous copy is kept.
+        ValueError: If upstream answers with something other than JSON. The previous copy is kept.
+        """
+        with self._lock:
+            self._sync()
+
+    def start(self):
+        """Start the background thread that syncs the directory every `ttl` seconds."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="member-directory-sync", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+            except ConnectionError as e:
+                logging.error("Member directory sync failed: %s", e)
+            except Exception:
+                # E.g. an HTML error page instead of JSON; the thread must keep running
+                logging.exception("Member directory sync failed")
+            time.sleep(self.ttl)
+
+    def _current(self):
+        state = self._state
+        if state[0] is not None and time.time() - state[0] < self.ttl:
+            return state
+        if state[0] is not None:
+            if not self._lock.acquire(blocking=False):
+                return state
+        else:
+            self._lock.acquire()
+        try:
+            if self._state[0] is None or time.time() - self._state[0] >= self.ttl:
+                self._sync()
+        except ConnectionError as e:
+            logging.error("Member directory sync failed: %s", e)
+        except Exception:
+            # Lookups keep the previous copy, or find nothing before the first successful sync
+            logging.exception("Member directory sync failed")
+        finally:
+            self._lock.release()
+        return self._state
+
+    def _sync(self):
+        """Download and index the member list. Must be called with _lock held."""
+        old_synced_at, old_by_name, old_by_memberid = self._state
+        try:
+            users = self._fetch()
+        except Exception:
+            if old_synced_at is not None:
+                # Keep the old copy and wait a full TTL before the next attempt.
+                self._state = (time.time(), old_by_name, old_by_memberid)
+            raise
+        by_memberid = {str(user.get("memberid")): user for user in users}
+        if old_synced_at is not None and by_memberid == old_by_memberid:
+            self._state = (time.time(), old_by_name, old_by_memberid)
+            return
+        by_name = {}
+        for user in users:
+            by_name.setdefault((user.get("firstname"), user.get("lastname")), user)
+        added = by_memberid.keys() - old_by_memberid.keys()
+        removed = old_by_memberid.keys() - by_memberid.keys()
+        changed = sum(1 for key in by_memberid.keys() & old_by_memberid.keys() if by_memberid[key] != old_by_memberid[key])
+        self._state = (time.time(), by_name, by_memberid)
+        logging.info("Member directory synced: %d members, %d added, %d removed, %d changed",
+                     len(by_memberid), len(added), len(removed), changed)
@@ -0,0 +1,282 @@
+import logging
+import math
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+
+def valid_memberid(memberid):
+    """Return whether `memberid` can be stored in the journal, which keeps it as 64-bit integer."""
+    if isinstance(memberid, bool):
+        return False
+    try:
+        return -2 ** 63 <= int(memberid) < 2 ** 63
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+
+def valid_amount(amount):
+    """Return whether `amount` is a positive finite number."""
+    return not isinstance(amount, bool) and isinstance(amount, (int, float)) and 0 < amount < math.inf
+
+
+class SaleJournal:
+    """
+    Durable write-ahead journal for sales that still have to be booked at Vereinsflieger.
+
+    A sale is appended to a SQLite database in WAL mode with synchronous=FULL, so it is on disk
+    when append() returns. A background thread started with start() claims due sales in batches,
+    hands them to the submit callable and marks them as sent. A failed submission is retried with
+    exponential backoff and marked as failed after `max_attempts` attempts.
+
+    Claiming happens in an IMMEDIATE transaction, so several processes can share one journal file
+    without submitting the same sale twice. A sale that stays claimed for longer than
+    `claim_timeout` seconds (e.g. because the process died while sending it) is retried.
+    """
+
+    def __init__(self, path, submit, batch_size=20, max_attempts=10, base_delay=5, max_delay=900,
+                 claim_timeout=300):
+        """
+        Parameters:
+        path (str): Path of the SQLite database file.
+        submit (callable): submit(sale) books one sale dict upstream and raises an exception on failure.
+        batch_size (int): Maximum number of sales claimed per round.
+        max_attempts (int): Number of attempts before a sale is marked as failed.
+        base_delay (float): Seconds before the first retry, doubled for every further attempt.
+        max_delay (float): Upper limit for the retry delay in seconds.
+        claim_timeout (float): Seconds after which a claimed but unfinished sale is retried.
+        """
+        self.path = path
+        self._submit = submit
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.claim_timeout = claim_timeout
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sales ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " created_at REAL NOT NULL,"
+            " memberid INTEGER NOT NULL,"
+            " articleid TEXT NOT NULL,"
+            " amount NUMERIC NOT NULL,"
+            " bookingdate TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " claimed_at REAL,"
+            " sent_at REAL,"
+            " last_error TEXT,"
+            " request_id TEXT)"
+        )
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(sales)")}
+        if "request_id" not in columns:
+            # Journals created before request tracing
+            self._db.execute("ALTER TABLE sales ADD COLUMN request_id TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS sales_due ON sales (state, next_attempt_at)")
+
+    def append(self, memberid, articleid, amount, bookingdate, request_id=None):
+        """
+        Write a sale to the journal and wake up the submission thread.
+
+        Parameters:
+        request_id (str): Optional correlation ID of the request that recorded the sale.
+
+        Returns:
+        int: The journal ID of the sale.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO sales (created_at, memberid, articleid, amount, bookingdate, state, next_attempt_at,"
+                " request_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (now, int(memberid), articleid, amount, bookingdate, PENDING, now, request_id),
+            )
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def append_claimed(self, sales, request_id=None):
+        """
+        Write several sales in one transaction, already claimed for submit_claimed().
+
+        The submission thread does not pick them up unless they stay claimed for longer than
+        `claim_timeout` seconds, e.g. because the process died before submitting them.
+
+        Parameters:
+        sales (list): (memberid, articleid, amount, bookingdate) tuples.
+        request_id (str): Optional correlation ID of the request that recorded the sales.
+
+        Returns:
+        list: The journal entries of the sales as dicts, in the order of `sales`.
+        """
+        if not sales:
+            return []
+        now = time.time()
+        # Converted before the transaction, so a bad memberid cannot leave it open
+        rows = [
+            (now, int(memberid), articleid, amount, bookingdate, SENDING, now, now, request_id)
+            for memberid, articleid, amount, bookingdate in sales
+        ]
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [
+                    self._db.execute(
+                        "INSERT INTO sales (created_at, memberid, articleid, amount, bookingdate, state,"
+                        " next_attempt_at, claimed_at, request_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        row,
+                    ).lastrowid
+                    for row in rows
+                ]
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._rollback()
+                raise
+            rows = {row["id"]: dict(row) for row in self._db.execute(
+                f"SELECT * FROM sales WHERE id IN ({','.join('?' * len(ids))})", ids
+            )}
+        return [rows[sale_id] for sale_id in ids]
+
+    def submit_claimed(self, sales, parallelism=1):
+        """
+        Submit claimed sales right away, at most `parallelism` at a time.
+
+        A sale that fails is scheduled for a retry by the submission thread like any other.
+
+        Returns:
+        list: One error message per sale, None for the sales that were submitted.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(sales)))) as pool:
+            return list(pool.map(self._submit_one, sales))
+
+    def get(self, sale_id):
+        """Return the journal entry of a sale as dict, or None if there is none."""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM sales WHERE id = ?", (sale_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def queue_depth(self):
+        """Return the number of pending (including currently sending) and failed sales."""
+        with self._lock:
+            counts = dict(self._db.execute(
+                "SELECT state, COUNT(*) FROM sales WHERE state != ? GROUP BY state", (SENT,)
+            ).fetchall())
+        return {
+            "pending": counts.get(PENDING, 0) + counts.get(SENDING, 0),
+            "sending": counts.get(SENDING, 0),
+            "failed": counts.get(FAILED, 0),
+        }
+
+    def start(self):
+        """Start the background thread that submits due sales."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="sale-journal", daemon=True)
+        self._thread.start()
+
+    def submit_due(self):
+        """
+        Claim one batch of due sales and submit them.
+
+        Returns:
+        int: The number of claimed sales.
+        """
+        sales = self._claim()
+        for sale in sales:
+            self._submit_one(sale)
+        return len(sales)
+
+    def _submit_one(self, sale):
+        """Submit one claimed sale and record the outcome. Returns the error message, or None."""
+        try:
+            self._submit(sale)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            self._mark_failed_attempt(sale, error)
+            return error
+        self._mark_sent(sale)
+        return None
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                if self.submit_due() == self.batch_size:
+                    continue
+            except sqlite3.Error as e:
+                logging.error("Sale journal error: %s", e)
+            self._wakeup.wait(self._seconds_until_due())
+
+    def _claim(self):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "UPDATE sales SET state = ? WHERE state = ? AND claimed_at < ?",
+                    (PENDING, SENDING, now - self.claim_timeout),
+                )
+                rows = self._db.execute(
+                    "SELECT * FROM sales WHERE state = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                    (PENDING, now, self.batch_size),
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE sales SET state = ?, claimed_at = ? WHERE id = ?",
+                    [(SENDING, now, row["id"]) for row in rows],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._rollback()
+                raise
+        return [dict(row) for row in rows]
+
+    def _rollback(self):
+        # Any exception inside a transaction must end it; otherwise every later write of this
+        # connection would silently join the open transaction and never be committed
+        if self._db.in_transaction:
+            self._db.execute("ROLLBACK")
+
+    def _mark_sent(self, sale):
+        with self._lock:
+            self._db.execute(
+                "UPDATE sales SET state = ?, sent_at = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?",
+                (SENT, time.time(), sale["id"]),
+            )
+
+    def _mark_failed_attempt(self, sale, error):
+        attempts = sale["attempts"] + 1
+        if attempts >= self.max_attempts:
+            logging.error("Giving up on sale %s after %d attempts: %s", sale["id"], attempts, error)
+            state = FAILED
+        else:
+            logging.warning("Submitting sale %s failed (attempt %d): %s", sale["id"], attempts, error)
+            state = PENDING
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        with self._lock:
+            self._db.execute(
+                "UPDATE sales SET state = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (state, attempts, time.time() + delay, error, sale["id"]),
+            )
+
+    def _seconds_until_due(self):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MIN(next_attempt_at) FROM sales WHERE state = ?", (PENDING,)
+            ).fetchone()
+        if row[0] is None:
+            # Nothing pending. Still look again now and then for sales appended by other processes.
+            return 60
+        return min(max(row[0] - time.time(), 0.1), 60)
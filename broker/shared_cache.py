@@ -0,0 +1,163 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SharedCache:
+    """
+    Key/value cache in a SQLite database that all broker processes on a host share.
+
+    With several worker processes (see wsgi.py) every worker keeps its own in-memory copies, but
+    reads them from here, so an upstream fetch (catalog download, login, member list) is done by
+    one process and reused by all others. get_or_fetch() serializes the fetches of a key across
+    processes with a lock row that expires after `lock_ttl` seconds, so a worker that dies while
+    fetching does not block the others forever.
+
+    Values are stored as JSON. The database is opened lazily per process, because SQLite
+    connections must not be shared across fork().
+    """
+
+    def __init__(self, path, poll_interval=0.05):
+        """
+        Parameters:
+        path (str): Path of the SQLite database file.
+        poll_interval (float): Seconds between two checks while waiting for another process's fetch.
+        """
+        self.path = path
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+
+    def _connection(self):
+        """Return the connection of this process. Must be called with self._lock held."""
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS locks ("
+                " name TEXT PRIMARY KEY,"
+                " owner TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def get(self, key):
+        """
+        Returns:
+        tuple: The value and the time.time() it was stored at, or None if the key is not set.
+        """
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value, updated_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        return (json.loads(row["value"]), row["updated_at"]) if row is not None else None
+
+    def updated_at(self, key):
+        """Return the time the key was last stored, or None. Cheaper than get() for change checks."""
+        with self._lock:
+            row = self._connection().execute("SELECT updated_at FROM entries WHERE key = ?", (key,)).fetchone()
+        return row["updated_at"] if row is not None else None
+
+    def set(self, key, value, updated_at=None):
+        updated_at = time.time() if updated_at is None else updated_at
+        with self._lock:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO entries (key, value, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), updated_at),
+            )
+        return updated_at
+
+    def delete(self, key, value=None):
+        """Remove the key. If `value` is given, only if it still holds that value."""
+        with self._lock:
+            if value is None:
+                self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+            else:
+                self._connection().execute("DELETE FROM entries WHERE key = ? AND value = ?", (key, json.dumps(value)))
+
+    def try_lock(self, name, ttl):
+        """
+        Take the lock `name` for `ttl` seconds without waiting.
+
+        Returns:
+        bool: True if this thread holds the lock now.
+        """
+        owner = self._owner()
+        now = time.time()
+        with self._lock:
+            db = self._connection()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT owner, expires_at FROM locks WHERE name = ?", (name,)).fetchone()
+                if row is not None and row["expires_at"] > now and row["owner"] != owner:
+                    db.execute("COMMIT")
+                    return False
+                db.execute(
+                    "INSERT OR REPLACE INTO locks (name, owner, expires_at) VALUES (?, ?, ?)",
+                    (name, owner, now + ttl),
+                )
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+        return True
+
+    def unlock(self, name):
+        with self._lock:
+            self._connection().execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, self._owner()))
+
+    def get_or_fetch(self, key, max_age, fetch, wait=True, lock_ttl=120):
+        """
+        Return the value of `key` if it is younger than `max_age` seconds, otherwise fetch and store it.
+
+        Only one process fetches a key at a time. The others wait for its result, or, with
+        wait=False, return None right away.
+
+        Parameters:
+        key (str): Cache key.
+        max_age (float): Maximum age of a stored value in seconds.
+        fetch (callable): fetch() returns the new value and raises an exception on failure.
+        wait (bool): Whether to wait while another process is fetching the key.
+        lock_ttl (float): Seconds after which the fetch lock of a dead process is taken over.
+
+        Raises:
+        TimeoutError: If another process held the fetch lock for more than `lock_ttl` seconds.
+
+        Returns:
+        tuple: The value and the time.time() it was stored at, or None (only with wait=False).
+        """
+        deadline = time.monotonic() + lock_ttl
+        while True:
+            entry = self.get(key)
+            if entry is not None and time.time() - entry[1] < max_age:
+                return entry
+            if self.try_lock(key, lock_ttl):
+                try:
+                    # Another process may have stored the key between get() and try_lock()
+                    entry = self.get(key)
+                    if entry is not None and time.time() - entry[1] < max_age:
+                        return entry
+                    value = fetch()
+                    return value, self.set(key, value)
+                finally:
+                    self.unlock(key)
+            if not wait:
+                return None
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Waited {lock_ttl} seconds for another process to fetch {key}")
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _owner():
+        return f"{os.getpid()}:{threading.get_ident()}"
@@ -0,0 +1,134 @@
+"""
+Request tracing for the broker.
+
+Every request gets a trace with the correlation ID sent by the kiosk in the X-Request-ID header
+(or a new one). vf_data records the upstream stages (login, API calls) into the current trace,
+which is kept per thread and, in the async broker, per asyncio task. A finished trace is written as one JSON log line and kept in a bounded
+in-memory buffer that can be queried.
+"""
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+HEADER = "X-Request-ID"
+VALID_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+logger = logging.getLogger("trace")
+
+
+class Trace:
+    """Timings of the stages of one request or background job."""
+
+    def __init__(self, name, trace_id=None):
+        # IDs from clients end up in log lines, so only harmless ones are taken over
+        self.id = trace_id if trace_id and VALID_ID.match(trace_id) else uuid.uuid4().hex
+        self.name = name
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.stages = []
+        self.fields = {}
+
+    def add(self, stage, seconds, **detail):
+        self.stages.append(dict(detail, stage=stage, ms=round(seconds * 1000, 1)))
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._start
+
+    def to_dict(self):
+        return dict(
+            self.fields,
+            trace_id=self.id,
+            name=self.name,
+            started=self.started,
+            total_ms=round(self.duration * 1000, 1) if self.duration is not None else None,
+            stages=list(self.stages),
+        )
+
+    def server_timing(self):
+        """Return the stages as value of a Server-Timing response header."""
+        return ", ".join(f"{s['stage']};dur={s['ms']}" for s in self.stages)
+
+
+class TraceBuffer:
+    """
+    The last `max_traces` finished traces.
+
+    Several traces can share one correlation ID, e.g. the kiosk's /getUserInfo and /Buy requests
+    of one vend and the later submission of the sale.
+    """
+
+    def __init__(self, max_traces=200):
+        self._traces = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def add(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def find(self, trace_id):
+        """Return all traces with the given correlation ID, oldest first."""
+        with self._lock:
+            return [trace for trace in self._traces if trace.id == trace_id]
+
+    def recent(self, limit=50):
+        """Return the newest `limit` traces, newest first."""
+        with self._lock:
+            traces = list(self._traces)
+        return traces[::-1][:limit]
+
+
+buffer = TraceBuffer(int(os.getenv('TRACE_BUFFER_SIZE', '200')))
+_current = contextvars.ContextVar("trace", default=None)
+
+
+def current():
+    """Return the trace of the current thread or asyncio task, or None."""
+    return _current.get()
+
+
+def set_current(trace):
+    _current.set(trace)
+
+
+@contextmanager
+def use(trace):
+    """Make `trace` the current trace for the with-block."""
+    previous = current()
+    set_current(trace)
+    try:
+        yield trace
+    finally:
+        set_current(previous)
+
+
+@contextmanager
+def stage(name, **detail):
+    """Record the duration of the with-block as stage of the current trace, if there is one."""
+    trace = current()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.add(name, time.perf_counter() - start, **detail)
+
+
+def finish(trace, **fields):
+    """
+    Complete a trace, log it as one JSON line and keep it in the buffer.
+
+    Traces without stages (requests served from memory) are only logged at debug level.
+    """
+    trace.fields.update(fields)
+    trace.finish()
+    buffer.add(trace)
+    logger.log(logging.INFO if trace.stages else logging.DEBUG, json.dumps(trace.to_dict()))
@@ -0,0 +1,115 @@
+"""
+Settings, metrics and catalog scheduling shared by the two Vereinsflieger clients, vf_data.py
+(threads, requests) and async_vf_data.py (asyncio, aiohttp). Both re-export the constants, so
+callers keep using e.g. vf_data.CON_ERROR.
+"""
+import logging
+import os
+import time
+from datetime import datetime
+
+import metrics
+import tracing
+from catalog import CatalogSnapshot
+
+SHARED_CACHE_FILE = "data/broker_cache.db"
+MEMBER_FILE = "data/token.json"
+SALE_JOURNAL_FILE = "data/sales.db"
+CACHE_TTL = 86400  # Cache validity in seconds
+CON_ERROR = "Connection error"
+SESSION_TTL = int(os.environ.get("API_SESSION_TTL", 1800))  # Seconds a signed-in access token is reused
+LOGIN_RETRY_DELAY = 5  # Seconds to wait after a failed login before trying again
+API_CONNECT_TIMEOUT = float(os.environ.get("API_CONNECT_TIMEOUT", 5))  # Seconds to connect to the API
+API_READ_TIMEOUT = float(os.environ.get("API_READ_TIMEOUT", 30))  # Seconds to wait for data from the API
+# Seconds between checks whether another worker process stored a newer catalog
+SHARED_CHECK_INTERVAL = float(os.environ.get("SHARED_CACHE_CHECK_INTERVAL", 5))
+# Seconds between two catalog downloads by the background scheduler (see start_catalog_scheduler)
+CATALOG_REFRESH_INTERVAL = int(os.environ.get("CATALOG_REFRESH_INTERVAL", 900))
+CATALOG_ROLLOVER_LEAD = 120  # Seconds before midnight the scheduler downloads the catalog for the next day
+CATALOG_RETRY_DELAY = 60  # Seconds before the scheduler retries a failed download
+CART_PARALLELISM = int(os.environ.get("CART_PARALLELISM", 4))  # Concurrent sale/add calls per cart
+
+UPSTREAM_SECONDS = metrics.histogram(
+    "broker_upstream_request_duration_seconds", "Duration of Vereinsflieger API calls by endpoint and status.")
+LOGINS = metrics.counter("broker_upstream_logins_total", "Vereinsflieger logins by result.")
+CATALOG_LOOKUPS = metrics.counter(
+    "broker_catalog_cache_total", "Shop items cache lookups (hit, stale, miss) and refreshes (refresh, refresh_error).")
+MEMBER_LOOKUPS = metrics.counter("broker_member_lookups_total", "Member lookups by index and result.")
+CON_ERRORS = metrics.counter("broker_con_error_total", "Calls answered with the CON_ERROR fallback by operation.")
+SALE_SUBMISSIONS = metrics.counter("broker_sale_submissions_total", "Sales sent to sale/add by result.")
+
+
+def upstream_stage(url):
+    """Return the trace stage and the metrics endpoint label of an API call."""
+    endpoint = url.split("interface/rest/", 1)[-1]
+    return ("upstream_login" if endpoint.startswith("auth/") else "upstream_call"), endpoint
+
+
+def checked_catalog_items(shop_items):
+    """
+    Return a downloaded article list for the shared cache.
+
+    Raises:
+        ConnectionError: If the download returned CON_ERROR instead of an article list.
+    """
+    if not isinstance(shop_items, dict):
+        raise ConnectionError("Error fetching shop items")
+    CATALOG_LOOKUPS.inc(result="refresh")
+    return shop_items
+
+
+def catalog_for_entry(snapshot, entry):
+    """Return `snapshot` if it holds the shared catalog entry (items, timestamp), otherwise a new snapshot of it."""
+    items, timestamp = entry
+    if snapshot is not None and snapshot.timestamp == timestamp:
+        return snapshot
+    return CatalogSnapshot(items, timestamp)
+
+
+def next_catalog_refresh(now):
+    """Time of the next scheduled download: after CATALOG_REFRESH_INTERVAL, or just before midnight if earlier."""
+    today = datetime.fromtimestamp(now).date()
+    rollover = datetime.combine(today, datetime.min.time()).timestamp() + 86400 - CATALOG_ROLLOVER_LEAD
+    if rollover <= now + 1:
+        rollover += 86400
+    return min(now + CATALOG_REFRESH_INTERVAL, rollover)
+
+
+def scheduled_refresh_done(started, snapshot=None, error=None):
+    """
+    Log the outcome of a scheduled catalog refresh and plan the next one.
+
+    Parameters:
+        started (float): time.time() when the refresh started.
+        snapshot (CatalogSnapshot): The refreshed catalog, if the refresh succeeded.
+        error (Exception): The error the refresh failed with, if it failed.
+
+    Returns:
+        tuple: Seconds to wait until the next refresh, and the `max_age` to pass to it.
+    """
+    if error is None:
+        logging.info("Catalog refreshed: %d items from %s", len(snapshot.items),
+                     datetime.fromtimestamp(snapshot.timestamp).isoformat(timespec="seconds"))
+        due = next_catalog_refresh(started)
+    else:
+        if isinstance(error, ConnectionError):
+            logging.error("Scheduled catalog refresh failed: %s", error)
+        else:
+            # E.g. an HTML error page instead of JSON, or a locked shared cache
+            logging.error("Scheduled catalog refresh failed", exc_info=error)
+        due = min(started + CATALOG_RETRY_DELAY, next_catalog_refresh(started))
+    wait = max(due - time.time(), 0)
+    # Several workers run a scheduler; the first one downloads, the others take its copy
+    return wait, wait / 2
+
+
+def submit_traced(submit, sale):
+    """Call submit(sale) for a journaled sale, traced under the correlation ID of the request that recorded it."""
+    trace = tracing.Trace("sale_submit", sale.get("request_id"))
+    try:
+        with tracing.use(trace):
+            submit(sale)
+    except ConnectionError as e:
+        tracing.finish(trace, saleid=sale["id"], attempt=sale["attempts"] + 1, error=str(e))
+        raise
+    tracing.finish(trace, saleid=sale["id"], attempt=sale["attempts"] + 1)
@@ -1,38 +1,235 @@
 import json
+import threading
 import time
 from datetime import datetime
 import os
 
 import requests
+from requests.adapters import HTTPAdapter
 import hashlib
 import logging
 
-CACHE_FILE = "data/shop_items_cache.json"
-CACHE_TTL = 86400  # Cache validity in seconds
-CON_ERROR = "Connection error"
+import metrics
+import tracing
+from catalog import CatalogSnapshot
+from members import MemberDirectory, MemberIndex
+from sale_journal import SaleJournal
+from shared_cache import SharedCache
+from vf_common import (API_CONNECT_TIMEOUT, API_READ_TIMEOUT, CACHE_TTL, CART_PARALLELISM, CATALOG_LOOKUPS,
+                       CATALOG_REFRESH_INTERVAL, CON_ERROR, CON_ERRORS, LOGIN_RETRY_DELAY, LOGINS, MEMBER_FILE,
+                       MEMBER_LOOKUPS, SALE_JOURNAL_FILE, SALE_SUBMISSIONS, SESSION_TTL, SHARED_CACHE_FILE,
+                       SHARED_CHECK_INTERVAL, UPSTREAM_SECONDS, catalog_for_entry, checked_catalog_items,
+                       scheduled_refresh_done, submit_traced, upstream_stage)
+
+CACHE_FILE = "data/shop_items_cache.json"  # Only read to seed SHARED_CACHE_FILE on the first start
+MEMBER_SYNC_INTERVAL = int(os.environ.get("MEMBER_SYNC_INTERVAL", 3600))  # Seconds between member list downloads
+HTTP_POOL_SIZE = int(os.environ.get("API_POOL_SIZE", 10))  # Kept-alive connections to the API
+HTTP_TIMEOUT = (API_CONNECT_TIMEOUT, API_READ_TIMEOUT)
+
+
+def _create_http_session():
+    """
+    Create the session shared by all API calls.
 
-def get_shop_items_cached():
-    # Check if cache file exists and is still valid
-    if os.path.exists(CACHE_FILE):
+    The connection pool of a session is thread-safe and keeps connections alive, so consecutive
+    calls reuse an open TLS connection instead of connecting and handshaking again.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_http = _create_http_session()
+
+def _http_request(method, url, **kwargs):
+    """
+    Send a request over the shared session with the configured connect and read timeouts.
+
+    Raises:
+    ConnectionError: If the request fails or times out.
+    """
+    stage, endpoint = upstream_stage(url)
+    with tracing.stage(stage, endpoint=endpoint), UPSTREAM_SECONDS.time(endpoint=endpoint, status="error") as labels:
+        try:
+            response = _http.request(method, url, timeout=HTTP_TIMEOUT, **kwargs)
+        except requests.RequestException as e:
+            raise ConnectionError(str(e)) from e
+        labels["status"] = str(response.status_code)
+    return response
+
+
+_member_index = MemberIndex(MEMBER_FILE)
+_shared = SharedCache(SHARED_CACHE_FILE)
+_catalog = None
+_catalog_checked = 0.0
+_catalog_lock = threading.Lock()
+_catalog_scheduler = None
+
+
+def _load_catalog_file():
+    """Read the catalog from the CACHE_FILE of older versions, or return None if there is no usable file."""
+    try:
         with open(CACHE_FILE, "r") as f:
             cached_data = json.load(f)
-            if time.time() - cached_data["timestamp"] < CACHE_TTL:
-                logging.info("Returning cached shop items from file.")
-                return cached_data["data"]
+        return CatalogSnapshot(cached_data["data"], cached_data["timestamp"])
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        logging.info("No usable shop items cache file: %s", e)
+        return None
+
 
-    # Fetch fresh data and write to cache file
+def _fetch_catalog_items():
     logging.info("Fetching fresh shop items and caching them.")
+    return checked_catalog_items(get_shop_items())
+
+
+def _use_shared_catalog(entry):
+    """Swap in the shared catalog entry if it differs from the current snapshot."""
+    global _catalog
+    _catalog = catalog_for_entry(_catalog, entry)
+
+
+def _refresh_catalog(wait):
+    """
+    Take the catalog from the shared cache, downloading it if it is older than CACHE_TTL.
+    Must be called with _catalog_lock held.
+    """
+    global _catalog_checked
+    _seed_shared_catalog()
     try:
-        shop_items = get_shop_items()
-        with open(CACHE_FILE, "w") as f:
-            json.dump({"timestamp": time.time(), "data": shop_items}, f)
-        return shop_items
-    except ConnectionError:
-        logging.error("Error fetching shop items. Returning cached data if available.")
-        if os.path.exists(CACHE_FILE):
-            with open(CACHE_FILE, "r") as f:
-                return json.load(f)["data"]
+        entry = _shared.get_or_fetch("catalog", CACHE_TTL, _fetch_catalog_items, wait=wait)
+    except (ConnectionError, TimeoutError) as e:
+        CATALOG_LOOKUPS.inc(result="refresh_error")
+        logging.error("Error fetching shop items (%s). Returning cached data if available.", e)
+        entry = _shared.get("catalog")
+    if entry is not None:
+        _use_shared_catalog(entry)
+    _catalog_checked = time.monotonic()
+    return _catalog
+
+
+def _seed_shared_catalog():
+    if _catalog is None and _shared.updated_at("catalog") is None:
+        legacy = _load_catalog_file()
+        if legacy is not None:
+            _shared.set("catalog", legacy.items, legacy.timestamp)
+
+
+def _check_shared_catalog():
+    """Pick up a catalog another worker process stored in the meantime."""
+    global _catalog_checked
+    _catalog_checked = time.monotonic()
+    updated_at = _shared.updated_at("catalog")
+    if updated_at is not None and updated_at != _catalog.timestamp:
+        entry = _shared.get("catalog")
+        if entry is not None:
+            _use_shared_catalog(entry)
+
+
+def get_catalog():
+    """
+    Return the current catalog snapshot, refreshing it when it is older than CACHE_TTL.
+
+    The catalog lives in the shared cache, so with several worker processes only one of them
+    downloads it. Only one thread per process refreshes at a time. While a refresh is running,
+    other threads get the previous snapshot; only threads that have no snapshot at all wait for it.
+
+    While the catalog scheduler runs (see start_catalog_scheduler), requests never download the
+    catalog themselves: they get the current snapshot however old it is, or the copy in the shared
+    cache, or None. Should the scheduler thread have died, requests download it again.
+
+    Returns:
+        CatalogSnapshot: The current snapshot, or None if neither upstream nor the shared cache has one.
+    """
+    snapshot = _catalog
+    if snapshot is not None and snapshot.age() < CACHE_TTL:
+        CATALOG_LOOKUPS.inc(result="hit")
+        if time.monotonic() - _catalog_checked >= SHARED_CHECK_INTERVAL and _catalog_lock.acquire(blocking=False):
+            try:
+                _check_shared_catalog()
+            finally:
+                _catalog_lock.release()
+            return _catalog
+        return snapshot
+    if _catalog_scheduler is not None and _catalog_scheduler.is_alive():
+        CATALOG_LOOKUPS.inc(result="stale" if snapshot is not None else "miss")
+        if snapshot is None and _catalog_lock.acquire(blocking=False):
+            try:
+                entry = _shared.get("catalog")
+                if entry is not None:
+                    _use_shared_catalog(entry)
+            finally:
+                _catalog_lock.release()
+        return _catalog
+    if snapshot is not None:
+        CATALOG_LOOKUPS.inc(result="stale")
+        if not _catalog_lock.acquire(blocking=False):
+            return snapshot
+    else:
+        CATALOG_LOOKUPS.inc(result="miss")
+        _catalog_lock.acquire()
+    try:
+        return _refresh_catalog(wait=snapshot is None)
+    finally:
+        _catalog_lock.release()
+
+
+def refresh_catalog(max_age=0):
+    """
+    Download the catalog unless the shared cache holds one that is at most `max_age` seconds old.
+
+    Raises:
+        ConnectionError: If the download fails. The current snapshot is kept.
+
+    Returns:
+        CatalogSnapshot: The current snapshot.
+    """
+    global _catalog_checked
+    with _catalog_lock:
+        _seed_shared_catalog()
+        try:
+            entry = _shared.get_or_fetch("catalog", max_age, _fetch_catalog_items)
+        except (ConnectionError, TimeoutError) as e:
+            CATALOG_LOOKUPS.inc(result="refresh_error")
+            raise ConnectionError(str(e)) from e
+        _use_shared_catalog(entry)
+        _catalog_checked = time.monotonic()
+        return _catalog
+
+
+def _run_catalog_scheduler():
+    # Warm-up: a catalog another worker or the previous run stored recently is good enough
+    max_age = CATALOG_REFRESH_INTERVAL
+    while True:
+        started = time.time()
+        try:
+            snapshot, error = refresh_catalog(max_age), None
+        except Exception as e:
+            # The thread must keep running whatever the download fails with
+            snapshot, error = None, e
+        wait, max_age = scheduled_refresh_done(started, snapshot, error)
+        time.sleep(wait)
+
+
+def start_catalog_scheduler():
+    """
+    Start the background thread that downloads the catalog right away, every CATALOG_REFRESH_INTERVAL
+    seconds and CATALOG_ROLLOVER_LEAD seconds before midnight. From then on requests only read it.
+    """
+    global _catalog_scheduler
+    if _catalog_scheduler is not None:
+        return
+    _catalog_scheduler = threading.Thread(target=_run_catalog_scheduler, name="catalog-scheduler", daemon=True)
+    _catalog_scheduler.start()
+
+
+def get_shop_items_cached():
+    snapshot = get_catalog()
+    if snapshot is None:
+        CON_ERRORS.inc(operation="get_shop_items_cached")
         return CON_ERROR
+    return snapshot.items
 
 # Get the data from the API
 def get_access_token():
@@ -51,7 +248,7 @@ def get_access_token():
         str: The access token if the request is successful.
         """
     url = _api_url + "interface/rest/auth/accesstoken"
-    response = requests.get(url)
+    response = _http_request("GET", url)
     data = response.json()
     return data.get("accesstoken")
 
@@ -104,7 +301,7 @@ def login():
     logging.debug(password)
     logging.debug('Accesstoken: ' + str(accesstoken))
     logging.debug(json.dumps(payload, indent=4))
-    response = requests.post(url, data=json.dumps(payload))
+    response = _http_request("POST", url, data=json.dumps(payload))
     logging.debug(response.text)
     if response.status_code == 200:
         return accesstoken
@@ -116,35 +313,151 @@ def login():
         raise ConnectionError("Server returned " + str(response.status_code))
 
 
+_session_lock = threading.Lock()
+_session_token = None
+_session_expires = 0.0
+_login_failed_at = 0.0
+
+
+def get_session_token():
+    """
+        Return the signed-in access token, logging in only if none is cached or the cached one expired.
+
+        The token is shared by all worker processes through the shared cache. Only one thread on the
+        host logs in at a time; threads and processes that arrive while a login is running wait for it
+        and then reuse its token instead of signing in themselves.
+
+        Raises:
+        ConnectionError: If the login fails or a login failed less than LOGIN_RETRY_DELAY seconds ago.
+
+        Returns:
+        str: The signed-in access token.
+        """
+    global _session_token, _session_expires, _login_failed_at
+    if _session_token and time.time() < _session_expires:
+        return _session_token
+    with _session_lock:
+        if _session_token and time.time() < _session_expires:
+            return _session_token
+        if time.time() - _login_failed_at < LOGIN_RETRY_DELAY:
+            raise ConnectionError("Login failed recently, not retrying yet")
+        try:
+            accesstoken, signed_in_at = _shared.get_or_fetch("session", SESSION_TTL, _login_counted)
+        except (ConnectionError, TimeoutError) as e:
+            _login_failed_at = time.time()
+            raise ConnectionError(str(e)) from e
+        _session_token = accesstoken
+        _session_expires = signed_in_at + SESSION_TTL
+        return accesstoken
+
+
+def _login_counted():
+    try:
+        accesstoken = login()
+    except ConnectionError:
+        LOGINS.inc(result="error")
+        raise
+    LOGINS.inc(result="ok")
+    return accesstoken
+
+
+def invalidate_session(accesstoken):
+    """
+        Drop the cached access token so the next call logs in again.
+
+        Only the token that was actually rejected is dropped, so a token another thread or process
+        already refreshed is kept.
+        """
+    global _session_token
+    with _session_lock:
+        if _session_token == accesstoken:
+            _session_token = None
+        _shared.delete("session", value=accesstoken)
+
+
+def post_with_session(url, payload=None):
+    """
+        Send a POST request with the cached access token added to the payload.
+
+        If the server answers 401 the token is dropped, a new one is obtained and the request is sent once more.
+
+        Returns:
+        requests.Response: The response of the last attempt.
+        """
+    accesstoken = get_session_token()
+    response = _http_request("POST", url, data=json.dumps({'accesstoken': accesstoken, **(payload or {})}))
+    if response.status_code == 401:
+        logging.info('Access token rejected, logging in again...')
+        invalidate_session(accesstoken)
+        accesstoken = get_session_token()
+        response = _http_request("POST", url, data=json.dumps({'accesstoken': accesstoken, **(payload or {})}))
+    return response
+
+
+def _fetch_member_list():
+    """
+        Download the member list from the API.
+        IMPORTANT: THIS FUNCTION REQUIRES THE RIGHT "Mitgliederdaten bearbeiten"/"Edit member data"
+
+        Raises:
+        ConnectionError: If the server returns any status code other than 200.
+
+        Returns:
+        list: The member dicts of the "users" field of the response.
+        """
+    logging.info('getting member list...')
+    url = _api_url + "interface/rest/user/list"
+    response = post_with_session(url)
+    if response.status_code != 200:
+        raise ConnectionError("Server returned " + str(response.status_code))
+    users = response.json().get("users") or []
+    logging.debug('Received %d members', len(users))
+    return users
+
+
+def _fetch_shared_member_list():
+    # Downloaded by one worker process, the others take the list from the shared cache
+    try:
+        return _shared.get_or_fetch("members", MEMBER_SYNC_INTERVAL, _fetch_member_list)[0]
+    except TimeoutError as e:
+        raise ConnectionError(str(e)) from e
+
+
+_member_directory = MemberDirectory(_fetch_shared_member_list, MEMBER_SYNC_INTERVAL)
+
+
+def start_member_sync():
+    """Start syncing the member directory in the background every MEMBER_SYNC_INTERVAL seconds."""
+    _member_directory.start()
+
+
 def get_vfid(vname, nname):
     """
         This function is used to get the member ID of a user by their first and last name.
         IMPORTANT: THIS FUNCTION REQUIRES THE RIGHT "Mitgliederdaten bearbeiten"/"Edit member data"
 
+        The lookup is answered from the locally cached member directory, which is synced with the
+        API every MEMBER_SYNC_INTERVAL seconds.
+
         Parameters:
         vname (str): The first name of the user.
         nname (str): The last name of the user.
 
         Returns:
-        int: The member ID of the user if found, otherwise 1.
+        int: The member ID of the user if found, otherwise None.
+        str: Returns "Connection error" if the member list has never been downloaded successfully.
         """
     logging.info('getting vfid for ' + vname + ' ' + nname + '...')
-    try:
-        accesstoken = login()
-        url = _api_url + "interface/rest/user/list"
-        payload = {
-            'accesstoken': accesstoken,
-        }
-        response = requests.post(url, data=json.dumps(payload))
-        logging.debug(json.dumps(response.json(), indent=4))
-        if response.status_code != 200:
-            raise ConnectionError("Server returned " + str(response.status_code))
-        for user in response.json().get("users"):
-            if user.get("firstname") == vname and user.get("lastname") == nname:
-                return user.get("memberid")
-    except ConnectionError:
+    user = _member_directory.by_name(vname, nname)
+    if user is not None:
+        MEMBER_LOOKUPS.inc(index="name", result="hit")
+        return user.get("memberid")
+    if _member_directory.stats()["synced_at"] is None:
         logging.error("Error while getting vfid returning internal ID")
-        return "Connection error"
+        CON_ERRORS.inc(operation="get_vfid")
+        return CON_ERROR
+    MEMBER_LOOKUPS.inc(index="name", result="miss")
+    return None
 
 def get_shop_items():
     """
@@ -187,140 +500,212 @@ def get_shop_items():
     url = _api_url+ "interface/rest/articles/list"
     logging.info('getting shop_items...')
     try:
-        accesstoken = login()
-        payload = {
-            'accesstoken': accesstoken,
-        }
-        response = requests.post(url, data=json.dumps(payload))
+        response = post_with_session(url)
         if response.status_code != 200:
             raise ConnectionError("Server returned " + str(response.status_code))
         else:
             return response.json()
     except ConnectionError:
         logging.error("Error while getting shop_items")
+        CON_ERRORS.inc(operation="get_shop_items")
         return CON_ERROR
 
 def get_fu_products():
-    articles = get_shop_items_cached()
-    prefix="Snackautomat Reihe "
-    filtered_articles = {
-        item_id: details
-        for item_id, details in articles.items()
-        if isinstance(details, dict) and details.get("articleid", "").startswith(prefix)
-    }
-    converted_articles = json.loads(json.dumps(filtered_articles, ensure_ascii=False))
-    return converted_articles
+    snapshot = get_catalog()
+    if snapshot is None:
+        return {}
+    return snapshot.fu_items
 
 def get_valid_fu_products():
     """
-     Filter shop items by their validity date range.
+     Filter the FU shop items by their validity date range.
 
-     This function checks all shop items in the given dictionary and filters
-     those that are valid for today's date based on their `validfrom` and `validto`
-     fields within `prices`.
-
-     Args:
-         articles (dict): Dictionary containing shop items. Each key is an item ID,
-                          and the value contains the article's details.
+     Returns the items that have a price valid for today's date based on the `validfrom` and
+     `validto` fields within `prices`, with `prices` reduced to those valid prices.
+     The dates are parsed once per catalog snapshot and the result is recomputed only at midnight
+     (see CatalogSnapshot.valid_fu_items), so this is a lookup on the request path.
 
      Returns:
-         dict: A new dictionary containing only the items that are valid today
-               (i.e., within the date range specified in `validfrom` and `validto`).
+         dict: A dictionary containing only the items that are valid today. The dictionary is
+               shared between requests and must not be modified.
 
      Example Usage:
-         >>> from datetime import datetime
-         >>> articles = {
-         ...     "31869": {
-         ...         "articleid": "211",
-         ...         "designation": "Fliegerlager Super Tanken",
-         ...         "prices": [
-         ...             {"validfrom": "2023-07-01", "validto": "2023-07-30"}
-         ...         ],
-         ...         "unittype": "Liter",
-         ...     },
-         ...     "34722": {
-         ...         "articleid": "FU_Test1",
-         ...         "designation": "Test für API Integrationen",
-         ...         "prices": [
-         ...             {"validfrom": "2024-04-01", "validto": "2024-10-01"}
-         ...         ],
-         ...         "unittype": "Stück",
-         ...     },
-         ...     "36641": {
-         ...         "articleid": "FU_Test2",
-         ...         "designation": "Super Plus",
-         ...         "prices": [
-         ...             {"validfrom": "2023-01-01", "validto": "9999-12-31"}
-         ...         ],
-         ...         "unittype": "Liter",
-         ...     },
-         ... }
-         >>> valid_articles = getValidFUProducts(articles)
+         >>> valid_articles = get_valid_fu_products()
          >>> print(valid_articles)
+         {'34722': {'articleid': 'Snackautomat Reihe 1', 'designation': 'Mars [1]',
+                    'prices': [{'validfrom': '2024-04-01', 'validto': '9999-12-31', ...}], ...}}
      """
-    today = datetime.now().date()
-    articles = get_fu_products()
-    filtered_articles = {}
+    snapshot = get_catalog()
+    if snapshot is None:
+        return {}
+    return snapshot.valid_fu_items()
 
-    for item_id, details in articles.items():
-        if not isinstance(details, dict):  # Skip non-dictionary entries
-            continue
 
-        valid_prices = []
+def get_catalog_json(view):
+    """
+    Return a catalog view pre-serialized, for conditional GET requests.
 
-        for price in details.get("prices", []):
-            try:
-                # Parse dates
-                valid_from = datetime.strptime(str(price["validfrom"]), "%Y-%m-%d").date()
-                valid_to = datetime.strptime(price["validto"], "%Y-%m-%d").date()
+    Parameters:
+        view (str): "items", "fu_items" or "valid_fu_items", see CatalogSnapshot.serialized.
+
+    Returns:
+        tuple: The JSON body and its content hash (the ETag), or None if there is no catalog.
+    """
+    snapshot = get_catalog()
+    if snapshot is None:
+        CON_ERRORS.inc(operation="get_catalog_json")
+        return None
+    return snapshot.serialized(view)
 
-                # Check if today is within the range
-                if valid_from <= today <= valid_to:
-                    valid_prices.append(price)
-            except (KeyError, ValueError):
-                # Skip entries with invalid or incomplete dates
-                continue
 
-        # If any valid prices are found, add the article to the result
-        if valid_prices:
-            filtered_articles[item_id] = {
-                **details,
-                "prices": valid_prices,  # Include only valid prices
-            }
+def get_row_map():
+    """
+    Return the products valid today by machine row, e.g. {"1": {...}, "2": {...}}.
 
-    return filtered_articles
+    The row is the tag in square brackets in the designation of the article.
+    """
+    snapshot = get_catalog()
+    if snapshot is None:
+        return {}
+    return snapshot.row_map()
 
 
-def set_new_sale(buyer, amount, item):
+def get_product_for_row(row):
+    """Return the product valid today for the given machine row, or None if no product is tagged for it."""
+    return get_row_map().get(str(row))
+
+
+def submit_sale(sale):
+    """
+    Book one sale at Vereinsflieger.
+
+    Parameters:
+        sale (dict): A sale with the keys "memberid", "articleid", "amount" and "bookingdate".
+                     If it has an "id" (the journal ID), it is added to the booking comment.
+
+    Raises:
+        ConnectionError: If the server responds with a status code other than 200.
+
+    Returns:
+        dict: JSON response from the server.
+    """
     url = _api_url + "interface/rest/sale/add"
     logging.info('setting shop buy...')
+    comment = "Automatisch gebucht"
+    if sale.get("id") is not None:
+        comment += " (#" + str(sale["id"]) + ")"
+    payload = {
+        'articleid': sale["articleid"],
+        'bookingdate': sale["bookingdate"],
+        'amount': sale["amount"],
+        'memberid': int(sale["memberid"]),
+        'comment': comment,
+    }
+    logging.debug(json.dumps(payload, indent=4))
     try:
-        accesstoken = login()
-        payload = {
-            'accesstoken': accesstoken,
-            'articleid': item["articleid"],
-            'bookingdate': datetime.now().date().isoformat(),
-            'amount': amount,
-            'memberid': int(buyer["memberid"]),
-            'comment': "Automatisch gebucht",
-        }
-        logging.debug(json.dumps(payload, indent=4))
-        response = requests.post(url, data=json.dumps(payload))
+        response = post_with_session(url, payload)
         if response.status_code != 200:
             raise ConnectionError("Server returned " + str(response.status_code))
-        else:
-            return response.json()
     except ConnectionError:
-        logging.error("Error while getting shop_items")
+        SALE_SUBMISSIONS.inc(result="error")
+        raise
+    SALE_SUBMISSIONS.inc(result="ok")
+    return response.json()
+
+
+def set_new_sale(buyer, amount, item):
+    try:
+        return submit_sale({
+            "memberid": buyer["memberid"],
+            "articleid": item["articleid"],
+            "amount": amount,
+            "bookingdate": datetime.now().date().isoformat(),
+        })
+    except ConnectionError:
+        logging.error("Error while setting new sale")
+        CON_ERRORS.inc(operation="set_new_sale")
         return CON_ERROR
 
 
+def _submit_journaled_sale(sale):
+    submit_traced(submit_sale, sale)
+
+
+_sale_journal = SaleJournal(SALE_JOURNAL_FILE, _submit_journaled_sale)
+
+
+def record_sale(buyer, amount, item):
+    """
+    Write a sale to the local sale journal. It is booked at Vereinsflieger by the background
+    submission thread (see start_sale_submission), so this does not wait for the API.
+
+    Returns:
+        int: The journal ID of the sale.
+    """
+    trace = tracing.current()
+    return _sale_journal.append(buyer["memberid"], item["articleid"], amount, datetime.now().date().isoformat(),
+                                request_id=trace.id if trace is not None else None)
+
+
+def book_cart(buyer, lines):
+    """
+    Journal the lines of a cart and book them at Vereinsflieger right away.
+
+    The lines are booked with the shared access token, at most CART_PARALLELISM at a time. A line
+    that cannot be booked now stays in the journal and is retried by the submission thread.
+
+    Parameters:
+        buyer (dict): The buyer with the key "memberid".
+        lines (list): (item, amount) tuples, the items as returned by get_valid_fu_products.
+
+    Returns:
+        list: One dict per line with the journal ID ("saleid"), "booked" and, if not booked, "error".
+    """
+    trace = tracing.current()
+    bookingdate = datetime.now().date().isoformat()
+    sales = _sale_journal.append_claimed(
+        [(buyer["memberid"], item["articleid"], amount, bookingdate) for item, amount in lines],
+        request_id=trace.id if trace is not None else None)
+    try:
+        # Log in once up front instead of letting the parallel submissions wait for each other
+        get_session_token()
+    except ConnectionError as e:
+        logging.warning("Login before booking cart failed: %s", e)
+    errors = _sale_journal.submit_claimed(sales, CART_PARALLELISM)
+    return [
+        {"saleid": sale["id"], "booked": error is None, **({"error": error} if error else {})}
+        for sale, error in zip(sales, errors)
+    ]
+
+
+def get_sale_queue_depth():
+    return _sale_journal.queue_depth()
+
+
+def start_sale_submission():
+    """Start the background thread that books the journaled sales at Vereinsflieger."""
+    _sale_journal.start()
+
+
 def get_user_info(keyname):
-    with open('data/token.json', 'r') as file:
-        users = json.load(file)
-    for user in users:
-        for key in user.get('keymanagement', []):
-            if key.get('keyname') == keyname:
-                return user
+    user = _member_index.lookup(keyname)
+    if user is not None:
+        MEMBER_LOOKUPS.inc(index="keyname", result="hit")
+        return user
 
+    MEMBER_LOOKUPS.inc(index="keyname", result="miss")
     return {"message": "User not found"}
+
+
+def get_member_index_stats():
+    return _member_index.stats()
+
+
+metrics.gauge("broker_catalog_age_seconds", "Age of the cached shop items.",
+              lambda: _catalog.age() if _catalog is not None else None)
+metrics.gauge("broker_member_index_entries", "Keynames in the RFID member index.",
+              lambda: _member_index.stats()["keys"])
+metrics.gauge("broker_member_directory_entries", "Members in the cached member directory.",
+              lambda: _member_directory.stats()["members"])
+metrics.gauge("broker_sale_queue_depth", "Journaled sales by state.",
+              lambda: {(("state", state),): count for state, count in get_sale_queue_depth().items()})
@@ -0,0 +1,22 @@
+"""
+WSGI entry point for production.
+
+gunicorn starts several worker processes, each importing this module after the fork. The
+workers share the catalog, the Vereinsflieger session and the member list through the SQLite
+shared cache (see shared_cache.py) and claim journaled sales with database transactions, so
+upstream fetches and logins happen once per host, not once per worker:
+
+    cd broker && gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import logging
+import os
+
+# main.py only configures logging when it is run as a script; without this, gunicorn would drop
+# every INFO line (catalog refreshes, request traces, sale retries)
+logging.basicConfig(level=logging.DEBUG if os.getenv('FLASK_ENV') == 'development' else logging.INFO,
+                    format="%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s")
+
+import main  # noqa: E402
+
+main.start_background_tasks()
+app = main.app
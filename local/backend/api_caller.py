@@ -1,9 +1,12 @@
 import datetime
 import os
+import time
 import jwt
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 from dotenv import load_dotenv
+import tracing
 
 # Load environment variables from .env file
 load_dotenv()
@@ -11,6 +14,23 @@ load_dotenv()
 # Check if self-signed certificates should be ignored
 ignore_self_signed_cert = os.getenv('IGNORE_SELF_SIGNED_CERT', 'false').lower() == 'true'
 
+# Connect and read timeout in seconds for broker requests
+timeout = (float(os.getenv('BROKER_CONNECT_TIMEOUT', '5')), float(os.getenv('BROKER_READ_TIMEOUT', '15')))
+
+# One session for all broker requests. Its thread-safe connection pool keeps the TLS connection
+# to the broker alive, so only the first request pays for the handshake.
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv('BROKER_POOL_SIZE', '4')))
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+# Seconds a signed JWT is reused before a new one is signed
+jwt_refresh_age = int(os.getenv('JWT_REFRESH_AGE', '300'))
+# subject -> (time.monotonic() of signing, request headers)
+auth_headers_cache = {}
+# path -> (ETag, decoded body) of the last full response of a conditional GET
+conditional_cache = {}
+
 def get_jwt_token(payload) -> str:
     key = os.environ.get('JWT_SECRET_KEY')
     if not isinstance(key, str):
@@ -19,61 +39,84 @@ def get_jwt_token(payload) -> str:
     token = jwt.encode(payload, key, algorithm="HS256")
     return token
 
-def get_user_by_rfid(rfid: str) -> dict:
+def get_auth_headers(subject: str) -> dict:
+    """
+    Return the request headers with a bearer token for the given subject.
+
+    The signed token and the headers are cached per subject and reused until they are
+    jwt_refresh_age seconds old. The returned dict is shared and must not be modified.
+    """
+    cached = auth_headers_cache.get(subject)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < jwt_refresh_age:
+        return cached[1]
     payload = {
-        "sub": "get_user_by_rfid",
+        "sub": subject,
         "name": "Frontend",
         "iat": datetime.datetime.utcnow()
     }
     headers = {"Authorization": f"Bearer {get_jwt_token(payload)}"}
-    response = requests.post(f"{os.environ.get('backendip')}/getUserInfo", json={"rfid_id": rfid}, headers=headers, verify=not ignore_self_signed_cert)
+    auth_headers_cache[subject] = (now, headers)
+    return headers
+
+def broker_request(method: str, path: str, subject: str, headers: dict = None, **kwargs) -> requests.Response:
+    """
+    Send an authenticated request to the broker and raise for error status codes.
+
+    If the calling thread has a trace (see tracing.use), its ID is sent in the X-Request-ID header
+    and the JWT, the broker hop and the stages reported by the broker are recorded in it.
+    """
+    trace = tracing.current()
+    with tracing.stage("jwt"):
+        auth_headers = get_auth_headers(subject)
+    headers = dict(auth_headers, **(headers or {}))
+    if trace is not None:
+        headers[tracing.HEADER] = trace.id
+    kwargs.setdefault("verify", not ignore_self_signed_cert)
+    with tracing.stage("broker_hop", path=path):
+        response = session.request(method, f"{os.environ.get('backendip')}{path}", headers=headers, timeout=timeout, **kwargs)
+    if trace is not None:
+        trace.add_server_timing(response.headers.get("Server-Timing"), prefix="broker.")
     response.raise_for_status()
-    return response.json()
+    return response
+
+def broker_get_conditional(path: str, subject: str):
+    """
+    GET a JSON resource, sending the ETag of the last response in If-None-Match.
+
+    If the broker answers 304 Not Modified, the body of the last response is returned without
+    downloading it again. The returned object is shared and must not be modified.
+    """
+    cached = conditional_cache.get(path)
+    headers = {"If-None-Match": cached[0]} if cached is not None else None
+    response = broker_request("GET", path, subject, headers=headers)
+    if response.status_code == 304 and cached is not None:
+        return cached[1]
+    body = response.json()
+    etag = response.headers.get("ETag")
+    if etag:
+        conditional_cache[path] = (etag, body)
+    return body
+
+def get_user_by_rfid(rfid: str) -> dict:
+    return broker_request("POST", "/getUserInfo", "get_user_by_rfid", json={"rfid_id": rfid}).json()
 
 def get_valid_products() -> dict:
-    payload = {
-        "sub": "get_valid_products",
-        "name": "Frontend",
-        "iat": datetime.datetime.utcnow()
-    }
-    headers = {"Authorization": f"Bearer {get_jwt_token(payload)}"}
-    response = requests.get(f"{os.environ.get('backendip')}/getValidFUProducts", headers=headers, verify=not ignore_self_signed_cert)
-    response.raise_for_status()
-    return response.json()
+    return broker_get_conditional("/getValidFUProducts", "get_valid_products")
 
 def get_product(row: str):
-    payload = {
-        "sub": "get_product",
-        "name": "Frontend",
-        "iat": datetime.datetime.utcnow()
-    }
-    headers = {"Authorization": f"Bearer {get_jwt_token(payload)}"}
-    response = requests.post(f"{os.environ.get('backendip')}/getSpecificProduct", json={"row": row}, headers=headers, verify=not ignore_self_signed_cert)
-    response.raise_for_status()
-    return response
+    return broker_request("POST", "/getSpecificProduct", "get_product", json={"row": row})
+
+def get_row_map() -> dict:
+    return broker_request("GET", "/getRowMap", "get_row_map").json()
 
 def set_new_sale(memberid: str, itemid: str, amount: int) -> dict:
-    payload = {
-        "sub": "set_new_sale",
-        "name": "Frontend",
-        "iat": datetime.datetime.utcnow()
-    }
-    headers = {"Authorization": f"Bearer {get_jwt_token(payload)}"}
-    response = requests.post(f"{os.environ.get('backendip')}/Buy", json={"memberid": memberid, "itemid": itemid, "amount": amount}, headers=headers, verify=not ignore_self_signed_cert)
-    response.raise_for_status()
-    return response.json()
+    return broker_request("POST", "/Buy", "set_new_sale", json={"memberid": memberid, "itemid": itemid, "amount": amount}).json()
 
 
 def test_connection():
-            payload = {
-                "sub": "test_connection",
-                "name": "Frontend",
-                "iat": datetime.datetime.utcnow()
-            }
-            headers = {"Authorization": f"Bearer {get_jwt_token(payload)}"}
-            response = requests.get(f"{os.environ.get('backendip')}/test", headers=headers, verify=False)
-            response.raise_for_status()
+            response = broker_request("GET", "/test", "test_connection", verify=False)
             if response.text == "Hello World":
                 return True
             else:
-                return False
\ No newline at end of file
+                return False
@@ -0,0 +1,69 @@
+import itertools
+import json
+import queue
+import threading
+
+KEEPALIVE_INTERVAL = 15  # Seconds between keep-alive comments on an idle stream
+
+
+class EventBus:
+    """
+    In-process publish/subscribe for the Server-Sent Events stream of the local API.
+
+    Every subscriber gets its own bounded queue. publish() never blocks: if a subscriber does not
+    keep up, its oldest event is dropped.
+    """
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def publish(self, event, data):
+        """Send an event with a JSON-serializable payload to all subscribers."""
+        message = (next(self._ids), event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stream(self):
+        """Generator yielding the events in text/event-stream format until the client disconnects."""
+        subscriber = self.subscribe()
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event_id, event, data = subscriber.get(timeout=KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+
+bus = EventBus()
+
+
+def publish(event, data):
+    bus.publish(event, data)
@@ -47,13 +47,18 @@ def create_interface(firstname, lastname):
     button_frame = tk.Frame(root)
     button_frame.pack(pady=20)
 
+    # Fetch the products of all rows in one request
+    try:
+        row_map = api_caller.get_row_map()
+    except Exception as e:
+        logging.debug(f"Error getting row map: {e}")
+        row_map = {}
+
     # Create buttons for the 12 rows and arrange them horizontally
     for i in range(1, 13):
         try:
-            product = api_caller.get_product(str(i))
-            product = product.json()
-            row_name = product['articleid']
-        except Exception as e:
+            row_name = row_map[str(i)]['articleid']
+        except (KeyError, TypeError) as e:
             logging.debug(f"Error getting product for row {i}: {e}")
             row_name = f"Placeholder Row {i}"
         button = tk.Button(
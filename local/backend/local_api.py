@@ -2,95 +2,225 @@ import logging
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from werkzeug.serving import is_running_from_reloader
 import worker
 import flask
-import api_caller, wifi_manager, read_nfc
+import api_caller, wifi_manager, read_nfc, events, tracing
 import os
+from product_cache import ProductCache
+from vend_queue import VendQueue
+from sales_ledger import SalesLedger
 
 app = Flask(__name__, static_url_path='/static')
 CORS(app)
 from dotenv import load_dotenv
 load_dotenv()
 
+broker_connected = None
+
+def report_broker_status(connected):
+    """Remember whether the last broker request succeeded and publish an event when that changes."""
+    global broker_connected
+    if connected != broker_connected:
+        broker_connected = connected
+        events.publish("broker", {"connected": connected})
+
+def call_broker(function, *args, **kwargs):
+    try:
+        result = function(*args, **kwargs)
+    except Exception:
+        report_broker_status(False)
+        raise
+    report_broker_status(True)
+    return result
+
+# job ID -> trace of a vend whose sale was not pushed to the broker yet
+vend_traces = {}
+
+def push_sale(sale):
+    # The first push of a vend's sale is part of its trace, retries are not
+    trace = vend_traces.pop(sale["job_id"], None)
+    try:
+        with tracing.use(trace):
+            call_broker(api_caller.set_new_sale, memberid=sale["memberid"], itemid=sale["itemid"], amount=sale["amount"])
+    except Exception as e:
+        if trace is not None:
+            tracing.finish(trace, state="pushing_failed", error=str(e))
+        raise
+    if trace is not None:
+        tracing.finish(trace, state="billed")
+
+def trace_vend(job):
+    """Add the queue and motor stages from the job history; finish the trace of a failed vend."""
+    if job.state == "queued":
+        # Called from submit() in the request thread, which has the trace of the vend
+        trace = tracing.current()
+        if trace is not None:
+            trace.fields["job_id"] = job.id
+            vend_traces[job.id] = trace
+            tracing.buffer.add(trace)
+        return
+    trace = vend_traces.get(job.id)
+    if trace is None:
+        return
+    at = dict(job.history)
+    if job.state == "confirmed" or (job.state == "failed" and "confirmed" not in at):
+        if "moving" in at:
+            trace.add("queue_wait", at["moving"] - at["queued"])
+            trace.add("motor_move", at.get("confirmed", at.get("failed", at["moving"])) - at["moving"])
+    if job.state == "failed" and vend_traces.pop(job.id, None) is not None:
+        tracing.finish(trace, state="failed", error=job.error)
+
+def on_vend_change(job):
+    trace_vend(job)
+    events.publish("vend", job.to_dict())
+
+sales_ledger_file = os.getenv('SALES_LEDGER_FILE', 'data/sales_ledger.db')
+os.makedirs(os.path.dirname(sales_ledger_file) or ".", exist_ok=True)
+def on_sale_settled(sale, error):
+    # The vend job is only billed once the broker accepted its sale
+    if sale["job_id"] is not None:
+        vend_queue.settle(sale["job_id"], error)
+
+sales_ledger = SalesLedger(sales_ledger_file, push_sale, on_settled=on_sale_settled)
+
+def bill_vend(job):
+    # Recorded locally first; the sync thread pushes it to the broker, which expects the item ID
+    sales_ledger.record(memberid=job.memberid, itemid=job.itemid, amount=1, job_id=job.id)
+
+# One dispatcher per vending controller; the machine currently has a single GRBL controller
+read_nfc.reader.on_read = lambda uid: events.publish("badge", {"rfid": uid.upper()})
+
+vend_queue = VendQueue("grbl", worker.run, bill_vend, on_change=on_vend_change)
+
 @app.route('/buy', methods=['POST'])
 def run_worker():
     data = flask.request.get_json()
     row = data.get('row')
     memberid = data.get('memberid')
-    try:
-        if worker.run(row) is True: # Call the worker function
-            api_caller.set_new_sale(memberid=memberid, itemid=row, amount=1)
-            return {"message": f"{row} processed successfully"}, 200
-        else:
-            return {"error": f"Failed to process {row}, internal error turning row. View local logs for more information"}, 500
-    except ConnectionError as ce:
-        print(f"Connection Error processing {row}: {ce}")
-        return {"error": "Connection error occurred"}, 500
-    except TimeoutError as te:
-        print(f"Timeout Error processing {row}: {te}")
-        return {"error": "Timeout error occurred"}, 500
-    except ValueError as ve:
-        print(f"Value Error processing {row}: {ve}")
-        return {"error": "Invalid value provided"}, 500
-    except Exception as e:
-        print(f"Unknown Error processing {row}: {e}")
-        return {"error": str(e)}, 500
+    if str(row) not in worker.ROW_COMMANDS:
+        return {"error": "Invalid value provided"}, 400
+    # Nothing is dispensed that could not be billed
+    itemid = product_cache.item_for_row(row)
+    if itemid is None:
+        return {"error": f"No product available in row {row}"}, 409
+    # Sent with the X-Request-ID of /get_user_info, the vend continues the trace of the badge read
+    trace = tracing.Trace("vend", request.headers.get(tracing.HEADER))
+    badge = tracing.buffer.get(trace.id)
+    if badge is not None and badge.name == "badge":
+        trace.stages.extend(badge.stages)
+    trace.fields.update(row=str(row), memberid=memberid, itemid=itemid)
+    with tracing.use(trace):
+        job = vend_queue.submit(str(row), memberid, itemid)
+    return job.to_dict(), 202, {"Location": f"/buy/{job.id}", tracing.HEADER: trace.id}
+
+@app.route('/buy/<job_id>', methods=['GET'])
+def get_vend_status(job_id):
+    job = vend_queue.get(job_id)
+    if job is None:
+        return {"error": f"Unknown job {job_id}"}, 404
+    return job.to_dict(), 200
+
+product_cache = ProductCache(
+    lambda: call_broker(api_caller.get_valid_products),
+    os.getenv('PRODUCT_CACHE_FILE', 'data/product_cache.json'),
+    int(os.getenv('PRODUCT_CACHE_TTL', '60')),
+)
 
 @app.route('/get_product_list', methods=['GET'])
 def get_products():
-    try:
-        products = api_caller.get_valid_products()
-        return products, 200
-    except Exception as e:
-        logging.debug(f"Error getting products: {e}")
-        products = {}
-        return products, 500
+    products, age = product_cache.get()
+    if products is None:
+        logging.debug("Error getting products: broker unreachable and no cached product list")
+        return {}, 500
+    headers = {
+        "Age": str(int(age)),
+        "X-Cache": "HIT" if age < product_cache.ttl else "STALE",
+    }
+    return products, 200, headers
 
 @app.route('/get_user_info', methods=['GET'])
 def login():
-    nfc_id = read_nfc.read_uid()
-    if nfc_id:
-        rfid = nfc_id.upper()
-        logging.debug(f"Read NFC tag with RFID: {rfid}")
-        try:
-            user_info = api_caller.get_user_by_rfid(rfid)
-            return user_info, 200
-        except Exception as e:
-            logging.debug(f"Error getting user info for RFID {rfid}: {e}")
-            return {f'error": User  for RFID {rfid} not found'}, 500
-    else:
-        return jsonify({"error": "Failed to read NFC tag"}), 500
+    # The frontend sends the returned X-Request-ID with the following /buy to join both traces
+    trace = tracing.Trace("badge", request.headers.get(tracing.HEADER))
+    headers = {tracing.HEADER: trace.id}
+    with tracing.use(trace):
+        with tracing.stage("nfc_read"):
+            # max_age lets the UI pick up a tap that happened just before the request
+            nfc_id = read_nfc.read_uid(max_age=request.args.get("max_age", default=0, type=float))
+        if nfc_id:
+            rfid = nfc_id.upper()
+            logging.debug(f"Read NFC tag with RFID: {rfid}")
+            try:
+                user_info = call_broker(api_caller.get_user_by_rfid, rfid)
+                events.publish("user", {"rfid": rfid, "user": user_info})
+                tracing.finish(trace, state="ok")
+                return user_info, 200, headers
+            except Exception as e:
+                logging.debug(f"Error getting user info for RFID {rfid}: {e}")
+                tracing.finish(trace, state="failed", error=str(e))
+                return {f'error": User  for RFID {rfid} not found'}, 500, headers
+        else:
+            tracing.finish(trace, state="no_tag")
+            return jsonify({"error": "Failed to read NFC tag"}), 500, headers
 
 
 @app.route('/health', methods=['GET'])
 def health_check():
     if os.getenv('FLASK_ENV') not in ['production', 'development']:
         return {"status": "error", "message": "FLASK_ENV not set correctly"}, 500
-    if api_caller.test_connection() is False:
+    try:
+        connected = call_broker(api_caller.test_connection)
+    except Exception as e:
+        logging.debug(f"Error testing broker connection: {e}")
+        connected = False
+    report_broker_status(connected)
+    if connected is False:
         return {"status": "error", "message": "Cannot connect to Broker"}, 500
     return {"status": "ok"}, 200
 
 
+@app.route('/sales/backlog', methods=['GET'])
+def get_sales_backlog():
+    return sales_ledger.backlog(), 200
+
+
+@app.route('/traces', methods=['GET'])
+def get_traces():
+    limit = request.args.get("limit", default=50, type=int)
+    return {"traces": [trace.to_dict() for trace in tracing.buffer.recent(limit)]}, 200
+
+
+@app.route('/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    trace = tracing.buffer.get(trace_id)
+    if trace is None:
+        return {"error": f"Unknown trace {trace_id}"}, 404
+    return trace.to_dict(), 200
+
+
+@app.route('/events', methods=['GET'])
+def event_stream():
+    """
+    Server-Sent Events stream of vend state changes ("vend"), badge reads ("badge", "user")
+    and broker connectivity changes ("broker").
+    """
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return flask.Response(flask.stream_with_context(events.bus.stream()), mimetype="text/event-stream", headers=headers)
+
+
 @app.route("/wifi/list", methods=['GET'])
 def api_wifi_list():
     refresh = request.args.get("refresh") in {"1", "true", "yes"}
     min_signal = request.args.get("min_signal", type=int)
     limit = request.args.get("limit", type=int)
 
-    try:
-        networks = wifi_manager.list_wifi()
-    except ConnectionError as e:
-        os.abort(503, description=str(e))
-
     if refresh:
-        # aktiven Rescan triggern und erneut lesen
-        from wifi_manager import run
-        try:
-            iface = wifi_manager.detect_wifi_iface()
-            run(f"nmcli device wifi rescan ifname {iface}")
-            networks = wifi_manager.detect_wifi_iface(iface)
-        except Exception:
-            pass
+        # aktiven Rescan im Hintergrund anstoßen, geantwortet wird mit dem letzten Ergebnis
+        wifi_manager.scanner.request_refresh()
+    networks, scanned_at, error = wifi_manager.scanner.results()
+    if error and scanned_at is None:
+        return jsonify({"error": error}), 503
 
     if min_signal is not None:
         networks = [n for n in networks if n["signal"] is not None and n["signal"] >= min_signal]
@@ -98,7 +228,13 @@ def api_wifi_list():
     if limit is not None and limit > 0:
         networks = networks[:limit]
 
-    return jsonify({"count": len(networks), "results": networks})
+    return jsonify({
+        "count": len(networks),
+        "results": networks,
+        "scanned_at": scanned_at,
+        "refreshing": wifi_manager.scanner.refreshing,
+        "error": error,
+    })
 
 
 @app.route("/wifi/connect", methods=['POST'])
@@ -155,6 +291,14 @@ def ota_update():
         return {"error": str(e)}, 500
 
 
+def start_background_tasks():
+    worker.controller.start()
+    vend_queue.start()
+    sales_ledger.start()
+    read_nfc.reader.start()
+    wifi_manager.scanner.start()
+
+
 if __name__ == '__main__':
     if os.getenv('FLASK_ENV') == 'production':
         app.config['DEBUG'] = False
@@ -164,4 +308,10 @@ if __name__ == '__main__':
         logging.basicConfig(level=logging.DEBUG)
     else:
         raise AttributeError("FLASK_ENV environment variable not set to 'production' or 'development'")
-    app.run(debug=True, host="0.0.0.0", port=8124)
\ No newline at end of file
+    debug = True
+    # With debug=True this module runs twice: in Werkzeug's reloader, which only watches the files, and
+    # in the child process it starts, which serves the requests. The NFC device, the GRBL port and the
+    # sales ledger must only be used by the serving process.
+    if not debug or is_running_from_reloader():
+        start_background_tasks()
+    app.run(debug=debug, host="0.0.0.0", port=8124)
\ No newline at end of file
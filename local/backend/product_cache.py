@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+# Machine row tag in the designation of a product, e.g. "Mars [3]" (the broker tags rows the same way)
+ROW_TAG = re.compile(r"\[([^\]]+)\]")
+
+
+class ProductCache:
+    """
+    Stale-while-revalidate cache for the product list of the broker.
+
+    get() always answers from memory. If the cached list is older than `ttl` seconds, a single
+    background thread fetches a new one while the old one keeps being served. The last good list
+    is written to `path`, so after a restart the kiosk has products before the broker is reachable.
+    """
+
+    def __init__(self, fetch, path, ttl):
+        """
+        :param fetch: Callable returning the product dict from the broker, raising on failure.
+        :param path: File the last good product list is persisted to.
+        :param ttl: Seconds after which the cached list is revalidated.
+        """
+        self._fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cold_lock = threading.Lock()
+        self._refreshing = False
+        self._loaded_file = False
+        # (products, time.time() of the fetch)
+        self._entry = (None, None)
+
+    def get(self):
+        """
+        Return the cached products and their age in seconds.
+
+        Only if there is neither a cached nor a persisted list, the broker is asked synchronously.
+
+        :return: (products, age), or (None, None) if no product list could be obtained.
+        """
+        products, fetched_at = self._entry
+        if products is None:
+            with self._lock:
+                if not self._loaded_file:
+                    self._loaded_file = True
+                    self._entry = self._load_file()
+            products, fetched_at = self._entry
+        if products is None:
+            with self._cold_lock:
+                if self._entry[0] is None:
+                    self.refresh()
+            products, fetched_at = self._entry
+            if products is None:
+                return None, None
+        age = max(time.time() - fetched_at, 0)
+        if age >= self.ttl:
+            self.refresh_in_background()
+        return products, age
+
+    def item_for_row(self, row):
+        """
+        Return the item ID of the product tagged with the machine row, as the broker's /Buy expects
+        it, or None if no cached product is tagged with the row. If several are, the first one wins.
+        """
+        products, _ = self.get()
+        if not isinstance(products, dict):
+            return None
+        for item_id, product in products.items():
+            if isinstance(product, dict) and str(row) in ROW_TAG.findall(product.get("designation", "")):
+                return item_id
+        return None
+
+    def refresh(self):
+        """Fetch the product list now. Returns False if the broker could not be reached."""
+        try:
+            products = self._fetch()
+        except Exception as e:
+            logging.debug(f"Error revalidating product cache: {e}")
+            return False
+        self._entry = (products, time.time())
+        self._write_file()
+        return True
+
+    def refresh_in_background(self):
+        """Start a revalidation thread unless one is already running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_and_clear, name="product-cache-refresh", daemon=True).start()
+
+    def _refresh_and_clear(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _load_file(self):
+        try:
+            with open(self.path, "r") as f:
+                cached = json.load(f)
+            logging.info(f"Loaded persisted product list from {self.path}")
+            return cached["data"], cached["timestamp"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug(f"No persisted product list: {e}")
+            return None, None
+
+    def _write_file(self):
+        products, fetched_at = self._entry
+        directory = os.path.dirname(self.path) or "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".product_cache.", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"timestamp": fetched_at, "data": products}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Could not persist product list: {e}")
@@ -1,12 +1,104 @@
+import collections
+import logging
 import subprocess
+import threading
+import time
 
-def read_uid():
-    cmd = "nfc-poll | awk '/UID/ {print $3$4$5$6$7$8$9; exit}'"
-    result = subprocess.run(
-        cmd,
-        shell=True,
-        capture_output=True,
-        text=True
-    )
-    uid = result.stdout.strip()
+DEBOUNCE_SECONDS = 3  # The same UID is reported again only after this many seconds without reading it
+RESTART_DELAY = 1  # Seconds to wait before restarting nfc-poll after it failed
+
+
+class NfcReader:
+    """
+    Background NFC reader.
+
+    A daemon thread keeps one `nfc-poll` child running and parses its output as it arrives. When
+    nfc-poll exits after a tag (or fails), it is started again in the background, so the reader is
+    never initialized on the request path. Read UIDs are debounced, kept in a ring buffer of recent
+    reads and handed to every thread waiting in wait_for_uid() and to the on_read callback.
+    """
+
+    def __init__(self, command=("nfc-poll",), history=50, on_read=None):
+        """
+        :param command: Command line of the polling process.
+        :param history: Number of recent reads kept in the ring buffer.
+        :param on_read: Optional callable on_read(uid), called for every debounced read.
+        """
+        self.command = list(command)
+        self.on_read = on_read
+        self.recent = collections.deque(maxlen=history)
+        self._reads = 0
+        self._last_uid = None
+        self._last_seen = 0.0
+        self._lock = threading.Lock()
+        self._new_read = threading.Condition(self._lock)
+        self._thread = None
+
+    def start(self):
+        """Start the reader thread if it is not running yet."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="nfc-reader", daemon=True)
+        self._thread.start()
+
+    def wait_for_uid(self, timeout=None, max_age=0):
+        """
+        Return the next UID that is read, or None if no tag was read within `timeout` seconds.
+
+        :param max_age: If a tag was read within the last `max_age` seconds, return it right away.
+        """
+        self.start()
+        with self._new_read:
+            if self.recent and time.time() - self.recent[-1][1] <= max_age:
+                return self.recent[-1][0]
+            reads = self._reads
+            if not self._new_read.wait_for(lambda: self._reads > reads, timeout):
+                return None
+            return self.recent[-1][0]
+
+    def _run(self):
+        while True:
+            try:
+                with subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                      text=True) as proc:
+                    for line in proc.stdout:
+                        uid = _parse_uid(line)
+                        if uid:
+                            self._publish(uid)
+                    returncode = proc.wait()
+                if returncode != 0:
+                    time.sleep(RESTART_DELAY)
+            except OSError as e:
+                logging.error(f"Could not start {self.command[0]}: {e}")
+                time.sleep(RESTART_DELAY * 10)
+
+    def _publish(self, uid):
+        now = time.monotonic()
+        if uid == self._last_uid and now - self._last_seen < DEBOUNCE_SECONDS:
+            self._last_seen = now
+            return
+        self._last_uid = uid
+        self._last_seen = now
+        with self._new_read:
+            self.recent.append((uid, time.time()))
+            self._reads += 1
+            self._new_read.notify_all()
+        if self.on_read is not None:
+            self.on_read(uid)
+
+
+def _parse_uid(line):
+    # Same as `awk '/UID/ {print $3$4$5$6$7$8$9}'` on the nfc-poll output
+    if "UID" not in line:
+        return None
+    fields = line.split()
+    return "".join(fields[2:9]) or None
+
+
+reader = NfcReader()
+
+
+def read_uid(timeout=30, max_age=0):
+    uid = reader.wait_for_uid(timeout, max_age)
     return uid or None
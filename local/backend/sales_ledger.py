@@ -0,0 +1,216 @@
+import logging
+import sqlite3
+import threading
+import time
+
+import requests
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+# Validation answers (status 400) of the broker's /Buy that will not change by sending the same sale
+# again. Everything else is retried, including auth errors (401/403/422, e.g. after JWT_SECRET_KEY
+# was mistyped or rotated), which go away once the kiosk's key is fixed.
+PERMANENT_MESSAGES = {"Invalid item", "Invalid memberid", "Invalid amount"}
+
+
+class SalesLedger:
+    """
+    Local ledger of every dispensed item on the kiosk.
+
+    A sale is written to a SQLite database (WAL, synchronous=FULL) as soon as the row was turned,
+    so vending never waits for the broker. A background sync thread pushes the pending sales to
+    the broker in batches, retries failures with exponential backoff and marks a sale as failed
+    when the broker rejects it or after `max_attempts` attempts.
+
+    Due sales are claimed in an IMMEDIATE transaction before they are pushed, so two processes
+    syncing the same ledger file never push the same sale. A sale that stays claimed for longer
+    than `claim_timeout` seconds (e.g. because the process died while pushing it) is retried.
+    """
+
+    def __init__(self, path, push, batch_size=20, max_attempts=20, base_delay=5, max_delay=900,
+                 claim_timeout=300, on_settled=None):
+        """
+        :param path: Path of the SQLite database file.
+        :param push: Callable push(sale) sending one sale dict to the broker, raising on failure.
+        :param batch_size: Maximum number of sales pushed per round.
+        :param max_attempts: Number of attempts before a sale is marked as failed.
+        :param base_delay: Seconds before the first retry, doubled for every further attempt.
+        :param max_delay: Upper limit for the retry delay in seconds.
+        :param claim_timeout: Seconds after which a claimed but unfinished sale is pushed again.
+        :param on_settled: Optional callable on_settled(sale, error), called when a sale was accepted by
+            the broker (error None) or was given up (error message).
+        """
+        self.path = path
+        self._push = push
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.claim_timeout = claim_timeout
+        self._on_settled = on_settled
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sales ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " created_at REAL NOT NULL,"
+            " job_id TEXT,"
+            " memberid TEXT,"
+            " itemid TEXT NOT NULL,"
+            " amount INTEGER NOT NULL,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " claimed_at REAL,"
+            " sent_at REAL,"
+            " last_error TEXT)"
+        )
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(sales)")}
+        if "claimed_at" not in columns:
+            # Ledgers created before sales were claimed
+            self._db.execute("ALTER TABLE sales ADD COLUMN claimed_at REAL")
+        self._db.execute("CREATE INDEX IF NOT EXISTS sales_due ON sales (state, next_attempt_at)")
+
+    def record(self, memberid, itemid, amount, job_id=None):
+        """Write a dispensed item to the ledger, wake up the sync thread and return the ledger ID."""
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO sales (created_at, job_id, memberid, itemid, amount, state, next_attempt_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (now, job_id, memberid, itemid, amount, PENDING, now),
+            )
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def backlog(self):
+        """Return the number of sales not yet accepted by the broker and of failed sales."""
+        with self._lock:
+            counts = dict(self._db.execute(
+                "SELECT state, COUNT(*) FROM sales WHERE state != ? GROUP BY state", (SENT,)
+            ).fetchall())
+            oldest = self._db.execute(
+                "SELECT MIN(created_at) FROM sales WHERE state IN (?, ?)", (PENDING, SENDING)
+            ).fetchone()[0]
+        return {
+            "pending": counts.get(PENDING, 0) + counts.get(SENDING, 0),
+            "failed": counts.get(FAILED, 0),
+            "oldest_pending_age": time.time() - oldest if oldest is not None else None,
+        }
+
+    def start(self):
+        """Start the background sync thread."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="sales-ledger-sync", daemon=True)
+        self._thread.start()
+
+    def sync(self):
+        """
+        Push one batch of due sales to the broker.
+
+        :return: The number of sales in the batch.
+        """
+        sales = self._claim()
+        for sale in sales:
+            try:
+                self._push(sale)
+            except Exception as e:
+                self._mark_failed_attempt(sale, e)
+            else:
+                with self._lock:
+                    self._db.execute(
+                        "UPDATE sales SET state = ?, sent_at = ?, attempts = attempts + 1, last_error = NULL"
+                        " WHERE id = ?",
+                        (SENT, time.time(), sale["id"]),
+                    )
+                self._settled(sale, None)
+        return len(sales)
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                if self.sync() == self.batch_size:
+                    continue
+            except sqlite3.Error as e:
+                logging.error(f"Sales ledger error: {e}")
+            self._wakeup.wait(self._seconds_until_due())
+
+    def _claim(self):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "UPDATE sales SET state = ? WHERE state = ? AND claimed_at < ?",
+                    (PENDING, SENDING, now - self.claim_timeout),
+                )
+                rows = self._db.execute(
+                    "SELECT * FROM sales WHERE state = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                    (PENDING, now, self.batch_size),
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE sales SET state = ?, claimed_at = ? WHERE id = ?",
+                    [(SENDING, now, row["id"]) for row in rows],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return [dict(row) for row in rows]
+
+    def _mark_failed_attempt(self, sale, error):
+        attempts = sale["attempts"] + 1
+        if _rejected(error) or attempts >= self.max_attempts:
+            logging.error(f"Giving up on sale {sale['id']} after {attempts} attempts: {error}")
+            state = FAILED
+        else:
+            logging.warning(f"Pushing sale {sale['id']} failed (attempt {attempts}): {error}")
+            state = PENDING
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        with self._lock:
+            self._db.execute(
+                "UPDATE sales SET state = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (state, attempts, time.time() + delay, str(error), sale["id"]),
+            )
+        if state == FAILED:
+            self._settled(sale, str(error))
+
+    def _settled(self, sale, error):
+        if self._on_settled is None:
+            return
+        try:
+            self._on_settled(sale, error)
+        except Exception:
+            logging.exception(f"Error reporting the outcome of sale {sale['id']}")
+
+    def _seconds_until_due(self):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MIN(next_attempt_at) FROM sales WHERE state = ?", (PENDING,)
+            ).fetchone()
+        if row[0] is None:
+            return 60
+        return min(max(row[0] - time.time(), 0.1), 60)
+
+
+def _rejected(error):
+    """Return whether the broker rejected the sale itself, so that sending it again is pointless."""
+    response = getattr(error, "response", None)
+    if not isinstance(error, requests.HTTPError) or response is None or response.status_code != 400:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and body.get("message") in PERMANENT_MESSAGES
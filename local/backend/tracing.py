@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Header carrying the correlation ID to the broker and back
+HEADER = "X-Request-ID"
+VALID_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+SERVER_TIMING = re.compile(r"^\s*([^;\s]+)\s*;\s*dur=([0-9.]+)")
+
+logger = logging.getLogger("trace")
+
+
+class Trace:
+    """
+    Timings of the stages of one vend (or badge read), recorded under one correlation ID.
+
+    The ID is sent to the broker with every request made while the trace is the current trace
+    of the thread (see use()), and the broker reports its own stages back in a Server-Timing header.
+    """
+
+    def __init__(self, name, trace_id=None):
+        self.id = trace_id if trace_id and VALID_ID.match(trace_id) else uuid.uuid4().hex
+        self.name = name
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.stages = []
+        self.fields = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, **detail):
+        with self._lock:
+            self.stages.append(dict(detail, stage=stage, ms=round(seconds * 1000, 1)))
+
+    def add_server_timing(self, header, prefix):
+        """Add the stages of a Server-Timing header, e.g. "upstream_login;dur=180.2, upstream_call;dur=95"."""
+        for entry in (header or "").split(","):
+            match = SERVER_TIMING.match(entry)
+            if match:
+                self.add(prefix + match.group(1), float(match.group(2)) / 1000)
+
+    def finish(self):
+        """Stop the clock. Returns False if the trace was already finished."""
+        with self._lock:
+            if self.duration is not None:
+                return False
+            self.duration = time.perf_counter() - self._start
+            return True
+
+    def to_dict(self):
+        with self._lock:
+            stages = list(self.stages)
+        return dict(
+            self.fields,
+            trace_id=self.id,
+            name=self.name,
+            started=self.started,
+            total_ms=round(self.duration * 1000, 1) if self.duration is not None else None,
+            stages=stages,
+        )
+
+
+class TraceBuffer:
+    """The last `max_traces` traces, including unfinished ones, by ID."""
+
+    def __init__(self, max_traces=200):
+        self.max_traces = max_traces
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, trace):
+        with self._lock:
+            self._traces.pop(trace.id, None)
+            self._traces[trace.id] = trace
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+
+    def get(self, trace_id):
+        with self._lock:
+            return self._traces.get(trace_id)
+
+    def recent(self, limit=50):
+        """Return the newest `limit` traces, newest first."""
+        with self._lock:
+            traces = list(self._traces.values())
+        return traces[::-1][:limit]
+
+
+buffer = TraceBuffer(int(os.getenv('TRACE_BUFFER_SIZE', '200')))
+_local = threading.local()
+
+
+def current():
+    """Return the trace of the current thread, or None."""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def use(trace):
+    """Make `trace` (which may be None) the trace of the current thread for the with-block."""
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextmanager
+def stage(name, **detail):
+    """Record the duration of the with-block as stage of the current trace, if there is one."""
+    trace = current()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.add(name, time.perf_counter() - start, **detail)
+
+
+def finish(trace, **fields):
+    """Complete a trace and write it as one JSON log line. Finishing a trace twice does nothing."""
+    trace.fields.update(fields)
+    if trace.finish():
+        buffer.add(trace)
+        logger.info(json.dumps(trace.to_dict()))
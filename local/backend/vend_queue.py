@@ -0,0 +1,153 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+QUEUED = "queued"
+MOVING = "moving"
+CONFIRMED = "confirmed"
+RECORDED = "recorded"  # Written to the local sales ledger, not yet accepted by the broker
+BILLED = "billed"
+BILLING_FAILED = "billing_failed"
+FAILED = "failed"
+
+
+class VendJob:
+    """One requested vend and the timestamps of the states it went through."""
+
+    def __init__(self, row, memberid, itemid=None):
+        self.id = uuid.uuid4().hex
+        self.row = row
+        self.memberid = memberid
+        self.itemid = itemid
+        self.state = QUEUED
+        self.error = None
+        self.history = [(QUEUED, time.time())]
+        # Outcome of the billing that arrived before the job was recorded, as 1-tuple (error,)
+        self._settlement = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "row": self.row,
+            "memberid": self.memberid,
+            "itemid": self.itemid,
+            "state": self.state,
+            "error": self.error,
+            "history": [{"state": state, "at": at} for state, at in self.history],
+        }
+
+
+class VendQueue:
+    """
+    Job queue for one vending controller.
+
+    submit() only enqueues a job and returns it. A single dispatcher thread takes the jobs one
+    after another, turns the row with `vend` and then records the sale with `bill`, so two taps can
+    never drive the same controller at the same time. The last `max_jobs` jobs stay queryable with get().
+
+    A job goes queued -> moving -> confirmed -> recorded, and then to billed or billing_failed when
+    settle() reports whether the broker accepted the sale; any step before can end in failed.
+    """
+
+    def __init__(self, name, vend, bill, max_jobs=200, on_change=None):
+        """
+        :param name: Name of the controller, used for the thread name and log messages.
+        :param vend: Callable vend(row) returning True once the row was turned.
+        :param bill: Callable bill(job) recording the sale, raising on failure.
+        :param max_jobs: Number of finished jobs kept for status queries.
+        :param on_change: Optional callable on_change(job), called after every state change.
+        """
+        self.name = name
+        self._vend = vend
+        self._bill = bill
+        self._on_change = on_change
+        self.max_jobs = max_jobs
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, row, memberid, itemid=None):
+        """Enqueue a vend and return the job. `itemid` is the product in the row, kept for billing."""
+        job = VendJob(row, memberid, itemid)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        if self._on_change is not None:
+            self._on_change(job)
+        self.start()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        """Return the job with the given ID, or None if it is unknown or was already dropped."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def settle(self, job_id, error=None):
+        """
+        Move a recorded job to billed, or to billing_failed if `error` is given. A result that
+        arrives before the job is recorded is applied once it is.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in (BILLED, BILLING_FAILED):
+                return
+            if job.state != RECORDED:
+                job._settlement = (error,)
+                return
+        self._set_state(job, BILLING_FAILED if error else BILLED, error)
+
+    def start(self):
+        """Start the dispatcher thread if it is not running yet."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=f"vend-{self.name}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._process(job)
+            except Exception as e:
+                logging.exception(f"Unexpected error processing vend job {job.id}")
+                self._set_state(job, FAILED, str(e))
+
+    def _process(self, job):
+        self._set_state(job, MOVING)
+        try:
+            result = self._vend(job.row)
+        except Exception as e:
+            self._set_state(job, FAILED, f"Failed to process {job.row}: {e}")
+            return
+        if result is not True:
+            self._set_state(job, FAILED, f"Failed to process {job.row}, internal error turning row. View local logs for more information")
+            return
+        self._set_state(job, CONFIRMED)
+        try:
+            self._bill(job)
+        except Exception as e:
+            self._set_state(job, FAILED, f"{job.row} was dispensed but the sale could not be recorded: {e}")
+            return
+        self._set_state(job, RECORDED)
+        with self._lock:
+            settlement, job._settlement = job._settlement, None
+        if settlement is not None:
+            self._set_state(job, BILLING_FAILED if settlement[0] else BILLED, settlement[0])
+
+    def _set_state(self, job, state, error=None):
+        job.state = state
+        job.error = error
+        job.history.append((state, time.time()))
+        if error:
+            logging.error(f"Vend job {job.id} ({self.name}, row {job.row}) {state}: {error}")
+        else:
+            logging.debug(f"Vend job {job.id} ({self.name}, row {job.row}) {state}")
+        if self._on_change is not None:
+            self._on_change(job)
@@ -1,5 +1,7 @@
 import subprocess
 import shlex
+import threading
+import time
 
 class WifiError(RuntimeError):
     pass
@@ -63,7 +65,7 @@ def wifi_connect(ssid: str, password: str, iface: str | None = None, bssid: str
     Verbindet mit SSID. Optional BSSID pinnen.
     Legt das Profil an oder aktualisiert es.
     """
-    iface = iface or detect_wifi_iface()
+    iface = iface or scanner.iface()
     args = f'nmcli device wifi connect "{ssid}" password "{password}" ifname {iface}'
     if bssid:
         args += f" bssid {bssid}"
@@ -83,3 +85,82 @@ def wifi_forget(ssid: str):
             return False
         raise
     return True
+
+class WifiScanner:
+    """
+    Wi-Fi state service for the local API.
+
+    Caches the detected interface and scans in a background thread every `interval` seconds.
+    The parsed results are kept in memory with the time of the scan, so requests never wait
+    for nmcli. request_refresh() asks the thread for an active rescan without waiting for it.
+    """
+
+    def __init__(self, interval=30):
+        self.interval = interval
+        self._iface = None
+        # (networks, time.time() of the scan, error message of the last scan or None)
+        self._state = ([], None, None)
+        self._rescan = False
+        self._rescanning = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def iface(self) -> str:
+        """Return the Wi-Fi interface, detecting it only on first use or after an error."""
+        iface = self._iface
+        if iface is None:
+            iface = detect_wifi_iface()
+            self._iface = iface
+        return iface
+
+    def results(self):
+        """Return (networks, scanned_at, error) of the last scan. scanned_at is None before the first scan."""
+        self.start()
+        return self._state
+
+    def request_refresh(self):
+        """Ask the background thread for an active rescan and return immediately."""
+        self._rescan = True
+        self.start()
+        self._wakeup.set()
+
+    @property
+    def refreshing(self):
+        """True while a requested rescan has not finished yet."""
+        return self._rescan or self._rescanning
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="wifi-scanner", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            self.scan()
+            self._wakeup.wait(self.interval)
+
+    def scan(self):
+        """Scan now in the calling thread and store the results."""
+        networks, scanned_at, _ = self._state
+        self._rescanning, self._rescan = self._rescan, False
+        try:
+            iface = self.iface()
+            if self._rescanning:
+                try:
+                    run(f"nmcli device wifi rescan ifname {iface}")
+                except WifiError:
+                    # NetworkManager refuses rescans in quick succession; the list is still current enough
+                    pass
+            self._state = (list_wifi(iface), time.time(), None)
+        except WifiError as e:
+            self._iface = None
+            self._state = (networks, scanned_at, str(e))
+        finally:
+            self._rescanning = False
+
+
+scanner = WifiScanner()
@@ -1,120 +1,214 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import serial
 from serial.tools import list_ports
 #import RPi.gpio
-from concurrent.futures import ThreadPoolExecutor
+
+BAUDRATE = 115200
+BANNER_TIMEOUT = 3  # Seconds to wait for the "Grbl" banner after opening a port
+REPLY_TIMEOUT = 5  # Seconds to wait for "ok" after a jog command
+
+# Optional USB identification of the controller, e.g. GRBL_VID=1a86 GRBL_PID=7523 (hex, as shown by lsusb)
+GRBL_VID = os.getenv('GRBL_VID')
+GRBL_PID = os.getenv('GRBL_PID')
+GRBL_SERIAL = os.getenv('GRBL_SERIAL')
+
+# Relay and jog command for every row
+ROW_COMMANDS = {
+    "1": (1, b"$J=G21G91X0.8F60\r\n"),
+    "2": (1, b"$J=G21G91Y0.8F60\r\n"),
+    "3": (1, b"$J=G21G91Z0.8F60\r\n"),
+    "4": (1, b"$J=G21G91A0.8F60\r\n"),
+    "5": (2, b"$J=G21G91X0.8F60\r\n"),
+    "6": (2, b"$J=G21G91Y0.8F60\r\n"),
+    "7": (2, b"$J=G21G91Z0.8F60\r\n"),
+    "8": (2, b"$J=G21G91A0.8F60\r\n"),
+    "9": (3, b"$J=G21G91X0.8F60\r\n"),
+    "10": (3, b"$J=G21G91Y0.8F60\r\n"),
+    "11": (3, b"$J=G21G91Z0.8F60\r\n"),
+    "12": (3, b"$J=G21G91A0.8F60\r\n"),
+}
 
 def relay(row):
     print(row)
 
 
-def check_port_for_grbl(port, axis):
-    """Attempt to connect to a specific port and check for GRBL response."""
-    print(f"Checking port: {port.device}")
-    try:
-        with serial.Serial(port.device, baudrate=115200, timeout=2) as ser:
-            # Read response from GRBL
-            response = ser.readlines()
-            if any(b"Grbl" in line for line in response):
-                print(f"Connected to GRBL on port: {port.device}")
-                try:
-                    match axis:
-                        case "1":
-                            relay(1)
-                            ser.write(b"$J=G21G91X0.8F60\r\n")
-                        case "2":
-                            relay(1)
-                            ser.write(b"$J=G21G91Y0.8F60\r\n")
-                        case "3":
-                            relay(1)
-                            ser.write(b"$J=G21G91Z0.8F60\r\n")
-                        case "4":
-                            relay(1)
-                            ser.write(b"$J=G21G91A0.8F60\r\n")
-                        case "5":
-                            relay(2)
-                            ser.write(b"$J=G21G91X0.8F60\r\n")
-                        case "6":
-                            relay(2)
-                            ser.write(b"$J=G21G91Y0.8F60\r\n")
-                        case "7":
-                            relay(2)
-                            ser.write(b"$J=G21G91Z0.8F60\r\n")
-                        case "8":
-                            relay(2)
-                            ser.write(b"$J=G21G91A0.8F60\r\n")
-                        case "9":
-                            relay(3)
-                            ser.write(b"$J=G21G91X0.8F60\r\n")
-                        case "10":
-                            relay(3)
-                            ser.write(b"$J=G21G91Y0.8F60\r\n")
-                        case "11":
-                            relay(3)
-                            ser.write(b"$J=G21G91Z0.8F60\r\n")
-                        case "12":
-                            relay(3)
-                            ser.write(b"$J=G21G91A0.8F60\r\n")
-                    if ser.readline() == b"ok\r\n":
-                        print("Turned successfully")
-                        ser.close()
-                    else:
-                        print("Failed to get response")
-                        ser.close()
-                        raise ConnectionError("Failed to get response from Arduino")
-                except Exception as e:
-                    print(e)
-                return port.device  # Return the port if GRBL is detected
-            else:
-                print(f"Not a GRBL device: {port.device}")
-                return None
-    except Exception as e:
-        print(f"Could not connect to {port.device}: {e}")
-    return None
-
-
-def find_and_connect_to_grbl(axis):
+class GrblController:
     """
-    Finds and connects to a GRBL-compatible device on available COM ports
-    and executes commands for the specified axis. Only ports containing
-    'USB' or 'COM' in their name are checked.
+    Long-lived connection to the GRBL controller.
 
-    :param axis: The axis to send commands for (e.g., 'X', 'Y', etc.).
-    :return: The first port where a GRBL device is found, or None if none are found.
+    The controller is discovered once, preferably by the USB VID/PID/serial number configured in
+    GRBL_VID, GRBL_PID and GRBL_SERIAL, otherwise by probing the USB/COM ports in parallel for the
+    "Grbl" banner. Ports are only written to (a soft reset for boards that print no banner on open)
+    when they were matched by USB ID, so other serial devices such as an NFC reader are left alone.
+    The port then stays open and every jog command is sent over it. If the port fails (e.g. the
+    controller was unplugged), it is closed and the controller is discovered again on the next command.
     """
-    # List all available COM ports
-    ports = list_ports.comports()
-    if not ports:
-        print("No COM ports found.")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._serial = None
+        self.device = None
+
+    def connect(self):
+        """Open the connection to the controller if it is not open yet. Returns the device path or None."""
+        with self._lock:
+            return self._connect()
+
+    def start(self):
+        """Discover the controller in the background, so the first vend does not wait for it."""
+        threading.Thread(target=self.connect, name="grbl-connect", daemon=True).start()
+
+    def jog(self, axis):
+        """
+        Send the jog command for the given row and wait for GRBL to accept it.
+
+        :param axis: The row to turn, "1" to "12".
+        :return: True if GRBL answered "ok", False otherwise.
+        :raises ValueError: If there is no command for the row.
+        :raises ConnectionError: If no GRBL controller can be found, or the connection is lost. The
+            command is only sent again if the connection was lost before it was written.
+        """
+        if str(axis) not in ROW_COMMANDS:
+            raise ValueError(f"No jog command for row {axis}")
+        relay_number, command = ROW_COMMANDS[str(axis)]
+        with self._lock:
+            for attempt in range(2):
+                if self._connect() is None:
+                    raise ConnectionError("No GRBL device found")
+                written = False
+                try:
+                    relay(relay_number)
+                    self._serial.reset_input_buffer()
+                    self._serial.write(command)
+                    written = True
+                    return self._wait_for_reply()
+                except (serial.SerialException, OSError) as e:
+                    print(f"Lost connection to GRBL on {self.device} (attempt {attempt + 1}): {e}")
+                    self._close()
+                    if written:
+                        # GRBL may already be moving; sending the jog again could dispense a second item
+                        raise ConnectionError("Lost connection to GRBL device after sending the jog command") from e
+                    # The controller was unplugged or reset before the command went out; reconnect once and send it
+            raise ConnectionError("Lost connection to GRBL device")
+
+    def _wait_for_reply(self):
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while time.monotonic() < deadline:
+            line = self._serial.readline().strip()
+            if line == b"ok":
+                print("Turned successfully")
+                return True
+            if line.startswith(b"error"):
+                print(f"GRBL rejected the command: {line.decode(errors='replace')}")
+                return False
+        print("Failed to get response")
+        return False
+
+    def _connect(self):
+        if self._serial is not None and self._serial.is_open:
+            return self.device
+        matched_by_usb_id = bool(GRBL_VID or GRBL_PID or GRBL_SERIAL)
+        ports = [port.device for port in self._candidate_ports()]
+        # Try the last known device alone first, it is the controller in almost all cases
+        if self.device in ports:
+            ser = self._open_if_grbl(self.device, matched_by_usb_id)
+            if ser is not None:
+                return self._use(ser, self.device)
+            ports.remove(self.device)
+        if ports:
+            with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+                found = list(pool.map(lambda device: self._open_if_grbl(device, matched_by_usb_id), ports))
+            for device, ser in zip(ports, found):
+                if ser is None:
+                    continue
+                if self._serial is None:
+                    self._use(ser, device)
+                else:
+                    ser.close()
+            if self._serial is not None:
+                return self.device
+        print("No GRBL device found.")
         return None
 
-    # Filter ports to include only those containing 'USB' or 'COM'
-    relevant_ports = [port for port in ports if "usb" in port.device.lower() or "com" in port.device.lower()]
-    if not relevant_ports:
-        print("No USB or COM ports found.")
+    def _use(self, ser, device):
+        self._serial = ser
+        self.device = device
+        print(f"Connected to GRBL on port: {device}")
+        return device
+
+    def _candidate_ports(self):
+        ports = list_ports.comports()
+        if GRBL_VID or GRBL_PID or GRBL_SERIAL:
+            ports = [port for port in ports if _matches_usb_id(port)]
+        else:
+            # Only ports containing 'USB' or 'COM' in their name are checked
+            ports = [port for port in ports if "usb" in port.device.lower() or "com" in port.device.lower()]
+        return ports
+
+    @classmethod
+    def _open_if_grbl(cls, device, soft_reset):
+        """Open the port and return it if a GRBL banner arrives; send a soft reset only if `soft_reset`."""
+        print(f"Checking port: {device}")
+        try:
+            ser = serial.Serial(device, baudrate=BAUDRATE, timeout=0.5)
+        except (serial.SerialException, OSError) as e:
+            print(f"Could not connect to {device}: {e}")
+            return None
+        try:
+            if cls._wait_for_banner(ser):
+                return ser
+            # Boards that do not reset on open only print the banner after a soft reset (Ctrl-X)
+            if soft_reset:
+                ser.write(b"\x18")
+                if cls._wait_for_banner(ser):
+                    return ser
+        except (serial.SerialException, OSError) as e:
+            print(f"Could not connect to {device}: {e}")
+        print(f"Not a GRBL device: {device}")
+        ser.close()
         return None
 
-    print(f"Found {len(relevant_ports)} relevant ports. Checking them in parallel for axis {axis}...")
+    @staticmethod
+    def _wait_for_banner(ser):
+        deadline = time.monotonic() + BANNER_TIMEOUT
+        while time.monotonic() < deadline:
+            if b"Grbl" in ser.readline():
+                return True
+        return False
 
-    # Use ThreadPoolExecutor to check relevant ports in parallel
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(check_port_for_grbl, port, axis) for port in relevant_ports]
+    def _close(self):
+        if self._serial is not None:
+            try:
+                self._serial.close()
+            except (serial.SerialException, OSError):
+                pass
+        self._serial = None
+
+
+def _matches_usb_id(port):
+    if GRBL_VID and (port.vid is None or port.vid != int(GRBL_VID, 16)):
+        return False
+    if GRBL_PID and (port.pid is None or port.pid != int(GRBL_PID, 16)):
+        return False
+    if GRBL_SERIAL and port.serial_number != GRBL_SERIAL:
+        return False
+    return True
+
+
+controller = GrblController()
 
-        # Wait for all tasks to complete and check results
-        for future in futures:
-            result = future.result()  # Blocks until the current thread finishes
-            if result:
-                print(f"GRBL device found on port: {result}")
-                return result  # Return the first port with a GRBL device
 
-    print("No GRBL device found.")
-    return None
 def run(axis):
-    # Attempt to find and connect to GRBL
     print(f"Turning every {axis} Axis")
-    grbl_port = find_and_connect_to_grbl(axis)
-    if grbl_port:
-        print("Connection successful!")
-        return True
-    else:
+    try:
+        if controller.jog(axis):
+            print("Connection successful!")
+            return True
+    except ConnectionError as e:
+        print(e)
         print("Make sure the GRBL device is connected and powered on.")
-        return "GRBL Error"
+    return "GRBL Error"